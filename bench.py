@@ -0,0 +1,515 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import wave
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+import anthropic
+import cv2
+import docx
+import numpy as np
+from openai import OpenAI
+from PIL import Image
+import indexer
+import retriever
+from metrics import get_metrics
+from scheduler import estimate_request_tokens, estimate_text_tokens
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TOPICS = [
+    'budget', 'invoice', 'vacation', 'recipe', 'physics', 'marketing', 'garden', 'contract', 'travel', 'security',
+    'hiring', 'music', 'weather', 'football', 'astronomy', 'medicine', 'chemistry', 'poetry', 'network', 'database'
+]
+FILLER = [
+    'the', 'report', 'team', 'plan', 'review', 'notes', 'summary', 'meeting', 'project', 'update', 'draft', 'list',
+    'details', 'schedule', 'results', 'overview', 'analysis', 'proposal', 'status', 'question', 'answer', 'version'
+]
+
+
+def get_topic_text(rng, topic, word_count):
+    words = [topic if rng.random() < 0.15 else rng.choice(FILLER) for _ in range(word_count)]
+    return f"Notes on {topic}. " + ' '.join(words)
+
+
+def write_pdf(path, pages):
+    # A minimal single-font PDF written by hand, so generating the corpus needs no PDF writer library
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        lines = textwrap.wrap(text, 90)[:60]
+        escaped = [line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') for line in lines]
+        stream = ("BT /F1 10 Tf 12 TL 40 800 Td " + ' '.join(f"({line}) Tj T*" for line in escaped) + " ET").encode('latin-1', 'replace')
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (' '.join(f"{kid} 0 R" for kid in kids).encode(), len(kids))
+
+    output = io.BytesIO()
+    output.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(output.tell())
+        output.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref_offset = output.tell()
+    output.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        output.write(b"%010d 00000 n \n" % offset)
+    output.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset))
+    path.write_bytes(output.getvalue())
+
+
+def write_docx(path, paragraphs):
+    document = docx.Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def write_image(path, rng, size):
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    pixels = np.stack([
+        np.add.outer(gradient, gradient) / 2,
+        np.tile(gradient, (size, 1)),
+        np.full((size, size), rng.randrange(256), dtype=np.float32)
+    ], axis=-1)
+    pixels += np.random.default_rng(rng.randrange(2 ** 32)).normal(0, 20, pixels.shape)
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path)
+
+
+def write_wav(path, rng, seconds, sample_rate=16000):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    samples = 0.3 * np.sin(2 * np.pi * rng.uniform(200, 800) * t)
+    with wave.open(str(path), 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((samples * 32767).astype(np.int16).tobytes())
+
+
+def write_video(path, rng, seconds, size=320, fps=10):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'MJPG'), fps, (size, size))
+    color = [rng.randrange(256) for _ in range(3)]
+    for frame_number in range(int(seconds * fps)):
+        frame = np.full((size, size, 3), color, dtype=np.uint8)
+        # A new scene every second, so key frame detection has something to find
+        if frame_number % fps == 0:
+            color = [rng.randrange(256) for _ in range(3)]
+        x = frame_number * 7 % (size - 40)
+        cv2.rectangle(frame, (x, x), (x + 40, x + 40), (255, 255, 255), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def generate_corpus(root, counts, text_kb=4, pdf_pages=2, image_size=1024, audio_seconds=5, video_seconds=3, seed=0):
+    rng = random.Random(seed)
+    root.mkdir(parents=True, exist_ok=True)
+    topics = {}
+    writers = {
+        'text': lambda path, topic: path.write_text(get_topic_text(rng, topic, text_kb * 1024 // 6), encoding='utf-8'),
+        'pdf': lambda path, topic: write_pdf(path, [get_topic_text(rng, topic, 400) for _ in range(pdf_pages)]),
+        'docx': lambda path, topic: write_docx(path, [get_topic_text(rng, topic, 80) for _ in range(10)]),
+        'image': lambda path, topic: write_image(path, rng, image_size),
+        'audio': lambda path, topic: write_wav(path, rng, audio_seconds),
+        'video': lambda path, topic: write_video(path, rng, video_seconds)
+    }
+    suffixes = {'text': '.txt', 'pdf': '.pdf', 'docx': '.docx', 'image': '.png', 'audio': '.wav', 'video': '.avi'}
+
+    for kind, count in counts.items():
+        for i in range(count):
+            topic = rng.choice(TOPICS)
+            # Nested folders with repeated file names, like real shares
+            path = root / kind / topic / f"{topic}_{i % 10}{suffixes[kind]}"
+            if path.exists():
+                path = path.with_name(f"{path.stem}_{i}{path.suffix}")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            writers[kind](path, topic)
+            topics[path.relative_to(root).as_posix()] = topic
+
+    total_bytes = sum(path.stat().st_size for path in root.rglob('*') if path.is_file())
+    print(f"Generated {len(topics)} files ({total_bytes / 1024 / 1024:.1f} MB) in {root}", file=sys.stderr)
+    return topics, total_bytes
+
+
+def get_message_text(kwargs):
+    texts = []
+    system = kwargs.get('system', '')
+    for message in [{'content': system}] + kwargs.get('messages', []):
+        content = message.get('content', '')
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(block.get('text', '') for block in content if block.get('type') == 'text')
+    return '\n'.join(texts)
+
+
+def get_fake_reply(kwargs):
+    text = get_message_text(kwargs)
+    if 'id|path|summary' in text:
+        # Retrieval: pick the overview lines that share a word with the query
+        query_terms = set(re.findall(r'\w+', text.rsplit('Query:', 1)[-1].lower()))
+        picked = [
+            match.group(1) for match in re.finditer(r'^(\d+)\|(.*)$', text, re.MULTILINE)
+            if query_terms & set(re.findall(r'\w+', match.group(2).lower()))
+        ]
+        return json.dumps({'file_id': ','.join(picked[:10])})
+
+    content = re.split(r'File content:|Audio transcript:|Key frames summary:', text, maxsplit=1)
+    words = [word for word in re.findall(r'[a-z]+', content[-1].lower()) if word not in FILLER] if len(content) > 1 else []
+    if not words:
+        return "This image shows synthetic shapes and colour gradients. The main points are: shapes, gradients, noise."
+    top_words = [word for word, _ in Counter(words).most_common(4)]
+    return f"This file is about {top_words[0]}. The main points are: {', '.join(top_words)}."
+
+
+class FakeRateLimitError(Exception):
+    # Shaped like the SDKs' 429 errors as far as the scheduler looks: a status code and a Retry-After header
+    status_code = 429
+
+    def __init__(self):
+        super().__init__("Simulated rate limit")
+        self.response = SimpleNamespace(status_code=429, headers={'retry-after-ms': '20'})
+
+
+class FakeBackend:
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.cached_prefixes = set()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = Counter()
+
+    def simulate(self):
+        with self.lock:
+            delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+            failed = self.rng.random() < self.error_rate
+            self.stats['calls'] += 1
+            self.stats['errors'] += failed
+        time.sleep(delay)
+        if failed:
+            raise FakeRateLimitError()
+
+    def account(self, kwargs, reply, cached_prefix=None):
+        # Token counts use the scheduler's estimate; a prefix seen before counts as a prompt cache read
+        input_tokens = estimate_request_tokens(kwargs) - kwargs.get('max_tokens', 0)
+        output_tokens = estimate_text_tokens(reply)
+        cache_read_tokens = cache_write_tokens = 0
+        if cached_prefix:
+            prefix_tokens = estimate_text_tokens(cached_prefix)
+            with self.lock:
+                if cached_prefix in self.cached_prefixes:
+                    cache_read_tokens = prefix_tokens
+                else:
+                    cache_write_tokens = prefix_tokens
+                    self.cached_prefixes.add(cached_prefix)
+        with self.lock:
+            self.stats['input_tokens'] += input_tokens
+            self.stats['output_tokens'] += output_tokens
+            self.stats['cache_read_tokens'] += cache_read_tokens
+            self.stats['cache_write_tokens'] += cache_write_tokens
+        return input_tokens, output_tokens, cache_read_tokens, cache_write_tokens
+
+
+class FakeAnthropicMessages:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, **kwargs):
+        self.backend.simulate()
+        reply = get_fake_reply(kwargs)
+        cached_prefix = None
+        for message in kwargs.get('messages', []):
+            if isinstance(message['content'], list):
+                blocks = [block for block in message['content'] if block.get('cache_control')]
+                if blocks:
+                    cached_prefix = get_message_text({'system': kwargs.get('system', '')}) + blocks[-1]['text']
+        input_tokens, output_tokens, cache_read_tokens, cache_write_tokens = self.backend.account(kwargs, reply, cached_prefix)
+        return SimpleNamespace(
+            content=[SimpleNamespace(type='text', text=reply)],
+            usage=SimpleNamespace(
+                input_tokens=input_tokens - cache_read_tokens - cache_write_tokens,
+                output_tokens=output_tokens,
+                cache_read_input_tokens=cache_read_tokens,
+                cache_creation_input_tokens=cache_write_tokens
+            )
+        )
+
+
+class FakeAnthropic(anthropic.Anthropic):
+    def __init__(self, backend):
+        super().__init__(api_key='bench', max_retries=0)
+        self.fake_messages = FakeAnthropicMessages(backend)
+
+    @property
+    def messages(self):
+        return self.fake_messages
+
+
+class FakeChatCompletions:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, **kwargs):
+        self.backend.simulate()
+        reply = get_fake_reply(kwargs)
+        text = get_message_text(kwargs)
+        cached_prefix = text.split('\n\nQuery:', 1)[0] if '\n\nQuery:' in text else None
+        input_tokens, output_tokens, cache_read_tokens, _ = self.backend.account(kwargs, reply, cached_prefix)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=reply))],
+            usage=SimpleNamespace(
+                prompt_tokens=input_tokens,
+                completion_tokens=output_tokens,
+                prompt_tokens_details=SimpleNamespace(cached_tokens=cache_read_tokens)
+            )
+        )
+
+
+class FakeTranscriptions:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, **kwargs):
+        self.backend.simulate()
+        upload = kwargs['file']
+        upload.read()
+        with self.backend.lock:
+            topic = self.backend.rng.choice(TOPICS)
+        return SimpleNamespace(text=f"Spoken notes about {topic} and the {topic} review meeting.")
+
+
+class FakeOpenAI(OpenAI):
+    def __init__(self, backend):
+        super().__init__(api_key='bench', max_retries=0)
+        self.fake_chat = SimpleNamespace(completions=FakeChatCompletions(backend))
+        self.fake_audio = SimpleNamespace(transcriptions=FakeTranscriptions(backend))
+
+    @property
+    def chat(self):
+        return self.fake_chat
+
+    @property
+    def audio(self):
+        return self.fake_audio
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None, None
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, KB elsewhere
+    return (
+        round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)
+    )
+
+
+def get_stage_seconds(metrics_before):
+    return {name: round(stats['seconds'], 3) for name, stats in get_metrics().since(metrics_before)['spans'].items()}
+
+
+def run_index_scenario(name, corpus_dir, client, backend, max_workers, extract_workers):
+    text_store = corpus_dir / 'folder_overview.text'
+    transcribe_function = indexer.transcribe_audio_openai
+    transcription_client = client if isinstance(client, OpenAI) else FakeOpenAI(backend)
+    summarize_document = lambda file_path, file_content=None: indexer.summarize_document(file_path, client, text_store, file_content)
+    summarize_image = lambda file_path, prepared_image=None: indexer.summarize_image(file_path, client, prepared_image)
+    summarize_audio = lambda file_path: indexer.summarize_audio(file_path, client, transcription_client, transcribe_function, text_store)
+    summarize_video = lambda file_path, key_frames=None: indexer.summarize_video(file_path, client, transcription_client, transcribe_function, text_store, key_frames)
+
+    backend.reset()
+    metrics_before = get_metrics().snapshot()
+    print(f"Running scenario {name}", file=sys.stderr)
+    start = time.perf_counter()
+    folder_overview = indexer.index_folder(
+        corpus_dir, summarize_document, summarize_image, summarize_audio, summarize_video,
+        max_workers=max_workers, extract_workers=extract_workers
+    )
+    indexer.save_folder_overview(corpus_dir, folder_overview)
+    elapsed = time.perf_counter() - start
+
+    peak_rss_mb, peak_children_rss_mb = get_peak_rss_mb()
+    return {
+        'files': len(folder_overview),
+        'seconds': round(elapsed, 3),
+        'files_per_second': round(len(folder_overview) / elapsed, 2) if elapsed > 0 else None,
+        'api_calls': backend.stats['calls'],
+        'api_errors': backend.stats['errors'],
+        'input_tokens': backend.stats['input_tokens'],
+        'output_tokens': backend.stats['output_tokens'],
+        'peak_rss_mb': peak_rss_mb,
+        'peak_children_rss_mb': peak_children_rss_mb,
+        'stage_seconds': get_stage_seconds(metrics_before)
+    }
+
+
+def run_retrieval_scenario(corpus_dir, client, backend, query_count, concurrency, seed):
+    rng = random.Random(seed)
+    queries = [f"{rng.choice(['files about', 'notes on', 'anything on'])} {rng.choice(TOPICS)}" for _ in range(query_count)]
+    process_query = retriever.process_query_anthropic if isinstance(client, anthropic.Anthropic) else retriever.process_query_openai
+    model = retriever.ANTHROPIC_MODEL if isinstance(client, anthropic.Anthropic) else retriever.OPENAI_MODEL
+    log_file = Path(tempfile.mkdtemp(prefix='filerag_bench_')) / 'api_response_log.txt'
+
+    load_start = time.perf_counter()
+    index = retriever.load_retrieval_index(corpus_dir / 'folder_overview.json')
+    load_seconds = time.perf_counter() - load_start
+
+    def run_one(query):
+        usage = {}
+        start = time.perf_counter()
+        try:
+            file_ids = retriever.answer_query(query, index, client, process_query, model, log_file, None, usage)
+        except FakeRateLimitError:
+            file_ids = []  # Retries exhausted; counted as an empty result
+        return (time.perf_counter() - start) * 1000, usage, file_ids
+
+    backend.reset()
+    metrics_before = get_metrics().snapshot()
+    print("Running scenario retrieval", file=sys.stderr)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(run_one, queries))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _, _ in results)
+    prompt_tokens = sorted(usage.get('input_tokens', 0) + usage.get('cache_read_tokens', 0) + usage.get('cache_write_tokens', 0) for _, usage, _ in results)
+    peak_rss_mb, peak_children_rss_mb = get_peak_rss_mb()
+    return {
+        'queries': len(queries),
+        'concurrency': concurrency,
+        'load_seconds': round(load_seconds, 3),
+        'seconds': round(elapsed, 3),
+        'queries_per_second': round(len(queries) / elapsed, 2) if elapsed > 0 else None,
+        'latency_p50_ms': round(retriever.get_percentile(latencies, 50), 2),
+        'latency_p95_ms': round(retriever.get_percentile(latencies, 95), 2),
+        'latency_p99_ms': round(retriever.get_percentile(latencies, 99), 2),
+        'prompt_tokens_mean': round(sum(prompt_tokens) / len(prompt_tokens), 1),
+        'prompt_tokens_max': prompt_tokens[-1],
+        'cache_read_tokens': sum(usage.get('cache_read_tokens', 0) for _, usage, _ in results),
+        'empty_results': sum(not file_ids for _, _, file_ids in results),
+        'api_calls': backend.stats['calls'],
+        'api_errors': backend.stats['errors'],
+        'peak_rss_mb': peak_rss_mb,
+        'peak_children_rss_mb': peak_children_rss_mb,
+        'stage_seconds': get_stage_seconds(metrics_before)
+    }
+
+
+def redirect_output(verbose):
+    # The indexer and retriever print as they go, also from extraction worker processes, so file descriptor 1
+    # itself is pointed at stderr or /dev/null and only the JSON results go to the original stdout
+    sys.stdout.flush()
+    results_stream = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+    os.dup2(2 if verbose else os.open(os.devnull, os.O_WRONLY), 1)
+    return results_stream
+
+
+def get_git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FileRAG benchmark with a synthetic corpus and a fake LLM backend")
+    parser.add_argument('--scenarios', default='index,reindex,retrieval', help="Comma-separated: index, reindex, retrieval")
+    parser.add_argument('--provider', choices=['a', 'o'], default='a', help="Which client interface to fake")
+    parser.add_argument('--text', type=int, default=200)
+    parser.add_argument('--pdf', type=int, default=20)
+    parser.add_argument('--docx', type=int, default=20)
+    parser.add_argument('--image', type=int, default=20)
+    parser.add_argument('--audio', type=int, default=5)
+    parser.add_argument('--video', type=int, default=5)
+    parser.add_argument('--text-kb', type=int, default=4)
+    parser.add_argument('--pdf-pages', type=int, default=2)
+    parser.add_argument('--image-size', type=int, default=1024)
+    parser.add_argument('--audio-seconds', type=float, default=5)
+    parser.add_argument('--video-seconds', type=float, default=3)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=1, help="Concurrent retrieval queries")
+    parser.add_argument('--latency', type=float, default=0.05, help="Mean fake API latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Uniform +/- jitter on the fake latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of fake calls failing with a 429")
+    parser.add_argument('--max-workers', type=int, default=None)
+    parser.add_argument('--extract-workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus', help="Directory for the generated corpus (default: a temporary directory)")
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    parser.add_argument('--verbose', action='store_true', help="Show the indexer and retriever output")
+    args = parser.parse_args()
+
+    results_stream = redirect_output(args.verbose)
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    corpus_dir = Path(args.corpus or tempfile.mkdtemp(prefix='filerag_corpus_')).resolve()
+    # A fresh summary and thumbnail cache, so the cold index run really does all the work for every file.
+    # Extraction worker processes re-import indexer, so they read it from the environment
+    os.environ['FILERAG_CACHE_DIR'] = tempfile.mkdtemp(prefix='filerag_bench_cache_')
+    indexer.CACHE_DIR = Path(os.environ['FILERAG_CACHE_DIR'])
+    counts = {'text': args.text, 'pdf': args.pdf, 'docx': args.docx, 'image': args.image, 'audio': args.audio, 'video': args.video}
+    topics, corpus_bytes = generate_corpus(
+        corpus_dir, counts, args.text_kb, args.pdf_pages, args.image_size, args.audio_seconds, args.video_seconds, args.seed
+    )
+
+    backend = FakeBackend(args.latency, args.jitter, args.error_rate, args.seed)
+    client = FakeAnthropic(backend) if args.provider == 'a' else FakeOpenAI(backend)
+    results = {
+        'commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': vars(args),
+        'corpus': {'files': len(topics), 'bytes': corpus_bytes, 'counts': counts},
+        'scenarios': {}
+    }
+
+    for scenario in scenarios:
+        if scenario in ['index', 'reindex']:
+            results['scenarios'][scenario] = run_index_scenario(
+                scenario, corpus_dir, client, backend, args.max_workers, args.extract_workers
+            )
+        elif scenario == 'retrieval':
+            if not (corpus_dir / 'folder_overview.json').is_file():
+                results['scenarios']['index'] = run_index_scenario(
+                    'index', corpus_dir, client, backend, args.max_workers, args.extract_workers
+                )
+            results['scenarios'][scenario] = run_retrieval_scenario(
+                corpus_dir, client, backend, args.queries, args.concurrency, args.seed
+            )
+        else:
+            print(f"Unknown scenario: {scenario}", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n', encoding='utf-8')
+        print(f"Benchmark results have been saved to {args.output}", file=sys.stderr)
+    else:
+        results_stream.write(output + '\n')
+        results_stream.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,16 @@
 import os
+import argparse
 import json
+import functools
+import hashlib
+import multiprocessing
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 import base64
 import anthropic
@@ -10,6 +21,40 @@ from PIL import Image
 import io
 import cv2
 import numpy as np
+from scheduler import call_provider
+from metrics import get_metrics, span, timed
+from watcher import create_watcher
+from overview_store import get_overview_version, write_overview_store, has_extracted_text, write_extracted_text, prune_extracted_text
+from search_index import build_bm25_index, save_bm25_index, build_vector_index, save_vector_index, build_overview_tree, save_overview_tree
+
+MAX_WORKERS = int(os.getenv('FILERAG_MAX_WORKERS', '8'))
+EXTRACT_WORKERS = int(os.getenv('FILERAG_EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+CACHE_DIR = Path(os.getenv('FILERAG_CACHE_DIR', Path.home() / '.cache' / 'filerag'))
+SUMMARY_CACHE_MAX_BYTES = int(os.getenv('FILERAG_SUMMARY_CACHE_MB', '256')) * 1024 * 1024
+EMBEDDER = os.getenv('FILERAG_EMBEDDER', 'hashed-ngram')
+JOURNAL_COMPACT_MB = os.getenv('FILERAG_JOURNAL_COMPACT_MB', '16')
+FRAME_PIXEL_BUDGET = int(os.getenv('FILERAG_FRAME_PIXELS', str(768 * 768)))
+FRAME_JPEG_QUALITY = int(os.getenv('FILERAG_FRAME_JPEG_QUALITY', '80'))
+AUDIO_BITRATE = os.getenv('FILERAG_AUDIO_BITRATE', '32k')
+AUDIO_CHUNK_SECONDS = int(os.getenv('FILERAG_AUDIO_CHUNK_SECONDS', '600'))
+AUDIO_MAX_UPLOAD_BYTES = int(os.getenv('FILERAG_AUDIO_MAX_UPLOAD_MB', '24')) * 1024 * 1024
+AUDIO_CHUNK_WORKERS = int(os.getenv('FILERAG_AUDIO_CHUNK_WORKERS', '4'))
+FFMPEG = shutil.which('ffmpeg')
+IMAGE_MAX_SIDE = int(os.getenv('FILERAG_IMAGE_MAX_SIDE', '1568'))
+IMAGE_MAX_BYTES = int(os.getenv('FILERAG_IMAGE_MAX_KB', '1024')) * 1024
+IMAGE_MEDIA_TYPES = {'jpeg': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif', 'webp': 'image/webp'}
+EXTRACTABLE_SUFFIXES = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.txt', '.md', '.pdf', '.docx', '.mp4', '.avi', '.mov', '.mkv']
+WATCH_DEBOUNCE = float(os.getenv('FILERAG_WATCH_DEBOUNCE', '2'))
+WATCH_MAX_DELAY = float(os.getenv('FILERAG_WATCH_MAX_DELAY', '60'))
+SKIPPED_DIRS = ['filerag_results', 'folder_overview.text']
+SCENE_CHANGE_THRESHOLD = 0.3
+DUPLICATE_FRAME_THRESHOLD = 0.05
+
+file_hashes = {}
+# Passed in place of extracted content to only look up the summary cache
+CACHED_ONLY = object()
+summary_cache_lock = threading.Lock()
+summary_cache_size = None
 
 
 def get_api_key(api_name):
@@ -33,12 +78,77 @@ def get_api_key(api_name):
     return api_key
 
 
-def summarize_document(file_path, client):
-    print(f"Summarizing document: {file_path}")
-    file_content = read_file_content(file_path)
-    if file_content is None:
+def get_summary_cache_key(content_hash, modality, model, system_message):
+    prompt_hash = hashlib.sha256(system_message.encode('utf-8')).hexdigest()
+    return hashlib.sha256(f"{content_hash}|{modality}|{model}|{prompt_hash}".encode('utf-8')).hexdigest()
+
+
+def get_summary_cache_path(cache_key):
+    return CACHE_DIR / 'summaries' / cache_key[:2] / f"{cache_key}.json"
+
+
+def get_cached_summary(cache_key):
+    cache_path = get_summary_cache_path(cache_key)
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            summary = json.load(f)['summary']
+        os.utime(cache_path)  # Mark as recently used for eviction
+        return summary
+    except (OSError, ValueError, KeyError):
         return None
 
+
+def store_cached_summary(cache_key, summary):
+    global summary_cache_size
+    if not summary:
+        return
+    cache_path = get_summary_cache_path(cache_key)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_name(f"{cache_path.name}.{threading.get_ident()}.tmp")
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'summary': summary}, f, ensure_ascii=False)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print(f"Error writing summary cache {cache_path}: {e}")
+        return
+
+    with summary_cache_lock:
+        if summary_cache_size is None:
+            summary_cache_size = sum(p.stat().st_size for p in (CACHE_DIR / 'summaries').glob('*/*.json'))
+        else:
+            summary_cache_size += cache_path.stat().st_size
+        if summary_cache_size > SUMMARY_CACHE_MAX_BYTES:
+            evict_summary_cache()
+
+
+def evict_summary_cache():
+    # Drops least recently used entries until the cache is back under 90% of its budget
+    global summary_cache_size
+    entries = []
+    for cache_path in (CACHE_DIR / 'summaries').glob('*/*.json'):
+        try:
+            stat = cache_path.stat()
+            entries.append((stat.st_mtime, stat.st_size, cache_path))
+        except OSError:
+            continue
+    entries.sort()
+    summary_cache_size = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, cache_path in entries:
+        if summary_cache_size <= SUMMARY_CACHE_MAX_BYTES * 0.9:
+            break
+        try:
+            cache_path.unlink()
+            summary_cache_size -= size
+            removed += 1
+        except OSError:
+            continue
+    print(f"Evicted {removed} entries from the summary cache")
+
+
+def summarize_document(file_path, client, text_store=None, file_content=None):
+    print(f"Summarizing document: {file_path}")
     system_message = """
     The assistant's job is to summarize the given article into 3-4 sentences. The first sentence should be the overview of the file, and the rest should be the main points of the article. The summary's language must be the same as the passage use.
     Here is the format for the summary:
@@ -46,11 +156,36 @@ def summarize_document(file_path, client):
     This file is about .... The main points are: {{first phrase}}, {{second phrase}}, {{third phrase}}, ...
     \"\"\"
     """
+    model = "claude-3-haiku-20240307" if isinstance(client, anthropic.Anthropic) else "gpt-4o"
+
+    try:
+        content_hash = hash_file(file_path)
+    except OSError as e:
+        print(f"Error reading file {file_path}: {e}")
+        return None
+    cache_key = get_summary_cache_key(content_hash, 'document', model, system_message)
+    cached_summary = get_cached_summary(cache_key)
+    if cached_summary and (text_store is None or has_extracted_text(text_store, content_hash)):
+        print(f"Using cached summary for: {file_path}")
+        return cached_summary
+    if file_content is CACHED_ONLY:
+        return None
+
+    if file_content is None:
+        file_content = read_file_content(file_path)
+    if file_content is None:
+        return None
+    if text_store is not None:
+        write_extracted_text(text_store, content_hash, file_content)
+    if cached_summary:
+        print(f"Using cached summary for: {file_path}")
+        return cached_summary
 
     try:
         if isinstance(client, anthropic.Anthropic):
-            message = client.messages.create(
-                model="claude-3-haiku-20240307",
+            message = call_provider(
+                client, client.messages.create,
+                model=model,
                 max_tokens=1500,
                 temperature=0.3,
                 system=system_message,
@@ -63,8 +198,9 @@ def summarize_document(file_path, client):
             )
             summary = message.content[0].text if message.content else None
         else:  # OpenAI
-            response = client.chat.completions.create(
-                model="gpt-4o",
+            response = call_provider(
+                client, client.chat.completions.create,
+                model=model,
                 messages=[
                     {"role": "system", "content": system_message},
                     {"role": "user", "content": f"File name: {file_path.name}\n\nFile content:\n{file_content[:2000]}"}
@@ -75,23 +211,15 @@ def summarize_document(file_path, client):
             summary = response.choices[0].message.content
         
         print(f"Summary generated for: {file_path}")
+        store_cached_summary(cache_key, summary)
         return summary
     except Exception as e:
         print(f"API error occurred: {e}")
         return None
 
 
-def summarize_image(file_path, client):
+def summarize_image(file_path, client, prepared_image=None):
     print(f"Summarizing image: {file_path}")
-
-    try:
-        media_type = get_image_media_type(file_path)
-        with open(file_path, "rb") as image_file:
-            image_data = base64.b64encode(image_file.read()).decode('utf-8')
-    except Exception as e:
-        print(f"Error processing image file {file_path}: {e}")
-        return None
-
     system_message = """
     The assistant's job is to summarize the given image into 3-4 sentences. The first sentence should be an overview, and the rest should describe the main elements or features of the image. And if the image contains text, please include the text in the summary.
     Here is the format for the summary:
@@ -99,11 +227,29 @@ def summarize_image(file_path, client):
     This image is about .... The main points are: {{first phrase}}, {{second phrase}}, {{third phrase}}, ...
     \"\"\"
     """
+    model = "claude-3-5-sonnet-20240620" if isinstance(client, anthropic.Anthropic) else "gpt-4-turbo"
+
+    try:
+        cache_key = get_summary_cache_key(hash_file(file_path), 'image', model, system_message)
+        cached_summary = get_cached_summary(cache_key)
+        if cached_summary:
+            print(f"Using cached summary for image: {file_path}")
+            return cached_summary
+        if prepared_image is CACHED_ONLY:
+            return None
+
+        media_type, image_bytes = prepared_image or prepare_image(file_path)
+        with span('encode'):
+            image_data = base64.b64encode(image_bytes).decode('utf-8')
+    except Exception as e:
+        print(f"Error processing image file {file_path}: {e}")
+        return None
 
     try:
         if isinstance(client, anthropic.Anthropic):
-            message = client.messages.create(
-                model="claude-3-5-sonnet-20240620",
+            message = call_provider(
+                client, client.messages.create,
+                model=model,
                 max_tokens=1500,
                 temperature=0.3,
                 system=system_message,
@@ -126,8 +272,9 @@ def summarize_image(file_path, client):
             )
             summary = message.content[0].text if message.content else None
         else:  # OpenAI
-            response = client.chat.completions.create(
-                model="gpt-4-turbo",
+            response = call_provider(
+                client, client.chat.completions.create,
+                model=model,
                 messages=[
                     {"role": "system", "content": system_message},
                     {
@@ -146,41 +293,78 @@ def summarize_image(file_path, client):
             summary = response.choices[0].message.content
         
         print(f"Summary generated for image: {file_path}")
+        store_cached_summary(cache_key, summary)
         return summary
     except Exception as e:
         print(f"API error occurred: {e}")
         return None
 
 
-def get_image_media_type(file_path):
+@timed('extract')
+def prepare_image(file_path, max_side=None, max_bytes=None):
+    # Reads and decodes the image once; oversized images are downscaled and recompressed to JPEG
+    if max_side is None:
+        max_side = IMAGE_MAX_SIDE
+    if max_bytes is None:
+        max_bytes = IMAGE_MAX_BYTES
+    with open(file_path, 'rb') as image_file:
+        image_bytes = image_file.read()
+
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        format = (img.format or '').lower()
+        if format not in IMAGE_MEDIA_TYPES:
+            raise ValueError(f"Unsupported image type: {format}")
+        if max(img.size) <= max_side and len(image_bytes) <= max_bytes:
+            return IMAGE_MEDIA_TYPES[format], image_bytes
+
+        content_hash = hashlib.sha256(image_bytes).hexdigest()
+        thumbnail_path = CACHE_DIR / 'images' / content_hash[:2] / f"{content_hash}_{max_side}_{max_bytes}.jpg"
+        if thumbnail_path.is_file():
+            return 'image/jpeg', thumbnail_path.read_bytes()
+
+        img.seek(0)  # First frame of animated GIF/WebP
+        if img.mode in ('RGBA', 'LA', 'P'):
+            rgba = img.convert('RGBA')
+            image = Image.new('RGB', rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel('A'))
+        else:
+            image = img.convert('RGB')
+
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    quality = 85
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        if buffer.tell() <= max_bytes or (quality <= 40 and min(image.size) <= 256):
+            break
+        if quality > 40:
+            quality -= 15
+        else:
+            image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)), Image.LANCZOS)
+
+    resized_bytes = buffer.getvalue()
+    print(f"Resized image {file_path} to {image.width}x{image.height}, {len(image_bytes)} -> {len(resized_bytes)} bytes")
     try:
-        with Image.open(file_path) as img:
-            format = img.format.lower()
-            if format == 'jpeg':
-                return 'image/jpeg'
-            elif format == 'png':
-                return 'image/png'
-            elif format == 'gif':
-                return 'image/gif'
-            elif format == 'webp':
-                return 'image/webp'
-            else:
-                raise ValueError(f"Unsupported image type: {format}")
-    except Exception as e:
-        raise ValueError(f"Error determining image type: {e}")
+        thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = thumbnail_path.with_name(f"{thumbnail_path.name}.{threading.get_ident()}.tmp")
+        temp_path.write_bytes(resized_bytes)
+        os.replace(temp_path, thumbnail_path)
+    except OSError as e:
+        print(f"Error caching resized image {thumbnail_path}: {e}")
+    return 'image/jpeg', resized_bytes
 
 
 def read_file_content(file_path):
     suffix = file_path.suffix.lower()
     try:
-        if suffix in ['.jpg', '.jpeg', '.png', '.gif']:
+        if suffix in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
             return "<<image_file>>"
         elif suffix == '.pdf':
             return read_pdf(file_path)
         elif suffix == '.docx':
             return read_docx(file_path)
         elif suffix in ['.txt', '.md']:
-            with open(file_path, 'r', encoding='utf-8') as f:
+            with span('read'), open(file_path, 'r', encoding='utf-8') as f:
                 return f.read()
         else:
             print(f"Unsupported file type: {suffix}")
@@ -190,6 +374,7 @@ def read_file_content(file_path):
         return None
 
 
+@timed('extract')
 def read_pdf(file_path):
     try:
         with open(file_path, 'rb') as file:
@@ -203,6 +388,7 @@ def read_pdf(file_path):
         return None
 
 
+@timed('extract')
 def read_docx(file_path):
     try:
         doc = Document(file_path)
@@ -216,7 +402,8 @@ def transcribe_audio_openai(file_path, client):
     print(f"Transcribing audio with OpenAI: {file_path}")
     try:
         with open(file_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
+            transcript = call_provider(
+                client, client.audio.transcriptions.create,
                 model="whisper-1",
                 file=audio_file
             )
@@ -230,7 +417,8 @@ def transcribe_audio_lemonfox(file_path, client):
     print(f"Transcribing audio with Lemonfox: {file_path}")
     try:
         with open(file_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
+            transcript = call_provider(
+                client, client.audio.transcriptions.create,
                 model="whisper-1",
                 file=audio_file
             )
@@ -250,11 +438,19 @@ def summarize_audio_transcript(transcript, client):
     This audio is about .... The main points are: {{first phrase}}, {{second phrase}}, {{third phrase}}, ...
     \"\"\"
     """
+    model = "claude-3-haiku-20240307" if isinstance(client, anthropic.Anthropic) else "gpt-4o"
+
+    cache_key = get_summary_cache_key(hashlib.sha256(transcript.encode('utf-8')).hexdigest(), 'audio', model, system_message)
+    cached_summary = get_cached_summary(cache_key)
+    if cached_summary:
+        print("Using cached audio summary")
+        return cached_summary
 
     try:
         if isinstance(client, anthropic.Anthropic):
-            message = client.messages.create(
-                model="claude-3-haiku-20240307",
+            message = call_provider(
+                client, client.messages.create,
+                model=model,
                 max_tokens=2000,
                 temperature=0.3,
                 system=system_message,
@@ -267,8 +463,9 @@ def summarize_audio_transcript(transcript, client):
             )
             summary = message.content[0].text if message.content else None
         else:  # OpenAI
-            response = client.chat.completions.create(
-                model="gpt-4o",
+            response = call_provider(
+                client, client.chat.completions.create,
+                model=model,
                 messages=[
                     {"role": "system", "content": system_message},
                     {"role": "user", "content": f"Audio transcript:\n{transcript[:2000]}"}
@@ -279,20 +476,116 @@ def summarize_audio_transcript(transcript, client):
             summary = response.choices[0].message.content
         
         print("Audio summary generated")
+        store_cached_summary(cache_key, summary)
         return summary
     except Exception as e:
         print(f"API error occurred: {e}")
         return None
 
 
-def summarize_audio(file_path, summarization_client, transcription_client, transcribe_function):
-    transcript = transcribe_function(file_path, transcription_client)
+def run_ffmpeg(args):
+    return subprocess.run([FFMPEG, '-hide_banner', '-loglevel', 'error', '-y', *args], capture_output=True, text=True)
+
+
+@timed('extract')
+def prepare_audio_chunks(file_path, work_dir):
+    # Demuxes the audio track and downmixes it to low-rate mono speech audio, split into chunks if still too large
+    compressed_path = work_dir / 'audio.mp3'
+    result = run_ffmpeg(['-i', str(file_path), '-vn', '-ac', '1', '-ar', '16000', '-b:a', AUDIO_BITRATE, str(compressed_path)])
+    if result.returncode != 0:
+        if 'does not contain any stream' in result.stderr or 'matches no streams' in result.stderr:
+            print(f"No audio track found in {file_path}")
+            return []
+        print(f"Error extracting audio from {file_path}: {result.stderr.strip()}")
+        return None
+
+    print(f"Compressed audio of {file_path} from {file_path.stat().st_size} to {compressed_path.stat().st_size} bytes")
+    if compressed_path.stat().st_size <= AUDIO_MAX_UPLOAD_BYTES:
+        return [compressed_path]
+
+    result = run_ffmpeg([
+        '-i', str(compressed_path), '-f', 'segment', '-segment_time', str(AUDIO_CHUNK_SECONDS),
+        '-c', 'copy', str(work_dir / 'chunk_%04d.mp3')
+    ])
+    if result.returncode != 0:
+        print(f"Error splitting audio from {file_path}: {result.stderr.strip()}")
+        return None
+    return sorted(work_dir.glob('chunk_*.mp3'))
+
+
+def transcribe_audio(file_path, client, transcribe_function):
+    if FFMPEG is None:
+        return transcribe_function(file_path, client)
+
+    with tempfile.TemporaryDirectory(prefix='filerag_audio_') as work_dir:
+        chunks = prepare_audio_chunks(Path(file_path), Path(work_dir))
+        if chunks is None:
+            print(f"Uploading original file for transcription: {file_path}")
+            return transcribe_function(file_path, client)
+        if not chunks:
+            # An empty transcript means there is no audio track, unlike None for a failed transcription
+            return ''
+        if len(chunks) == 1:
+            return transcribe_function(chunks[0], client)
+
+        print(f"Transcribing {len(chunks)} audio chunks of {file_path}")
+        with ThreadPoolExecutor(max_workers=max(1, min(len(chunks), AUDIO_CHUNK_WORKERS))) as executor:
+            transcripts = list(executor.map(lambda chunk: transcribe_function(chunk, client), chunks))
+        if any(transcript is None for transcript in transcripts):
+            return None
+        return '\n'.join(transcript.strip() for transcript in transcripts)
+
+
+def summarize_audio(file_path, summarization_client, transcription_client, transcribe_function, text_store=None):
+    # Transcripts are cached too, so duplicate recordings skip the upload as well
+    try:
+        content_hash = hash_file(file_path)
+    except OSError as e:
+        print(f"Error reading audio file {file_path}: {e}")
+        return None
+    cache_key = get_summary_cache_key(content_hash, 'transcript', transcribe_function.__name__, '')
+    transcript = get_cached_summary(cache_key)
     if transcript:
+        print(f"Using cached transcript for: {file_path}")
+    else:
+        transcript = transcribe_audio(file_path, transcription_client, transcribe_function)
+        store_cached_summary(cache_key, transcript)
+    if transcript:
+        if text_store is not None:
+            write_extracted_text(text_store, content_hash, transcript)
         return summarize_audio_transcript(transcript, summarization_client)
-    return None
+    return '' if transcript == '' else None
+
+
+def resize_to_pixel_budget(frame, max_pixels):
+    height, width = frame.shape[:2]
+    if height * width <= max_pixels:
+        return frame
+    scale = (max_pixels / (height * width)) ** 0.5
+    return cv2.resize(frame, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+
 
+def get_frame_histogram(frame):
+    small = cv2.resize(frame, (64, 36), interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    histogram = cv2.calcHist([hsv], [0, 1], None, [16, 16], [0, 180, 0, 256])
+    return cv2.normalize(histogram, histogram).flatten()
 
-def extract_key_frames(video_path, num_frames=5):
+
+def thin_samples(samples, num_frames):
+    # Keeps the first sample and the strongest scene cuts, and every second of the other samples
+    cuts = sorted((sample for sample in samples[1:] if sample[1] >= SCENE_CHANGE_THRESHOLD), key=lambda sample: -sample[1])[:num_frames - 1]
+    kept_indices = {samples[0][0]} | {sample[0] for sample in cuts}
+    others = [sample for sample in samples if sample[0] not in kept_indices]
+    kept_indices |= {sample[0] for sample in others[::2]}
+    return [sample for sample in samples if sample[0] in kept_indices]
+
+
+@timed('extract')
+def extract_key_frames(video_path, num_frames=5, samples_per_frame=8, max_pixels=None):
+    # Decodes the video once front to back instead of seeking per frame, which re-decodes from the last keyframe
+    if max_pixels is None:
+        max_pixels = FRAME_PIXEL_BUDGET
     video_path_str = str(video_path)  # Convert Path to string
     video = cv2.VideoCapture(video_path_str)
     if not video.isOpened():
@@ -300,27 +593,63 @@ def extract_key_frames(video_path, num_frames=5):
         return []
 
     total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_indices = np.linspace(0, total_frames - 1, num_frames, dtype=int)
-
-    key_frames = []
-    for idx in frame_indices:
-        video.set(cv2.CAP_PROP_POS_FRAMES, idx)
-        ret, frame = video.read()
-        if ret:
-            key_frames.append(frame)
-
+    if total_frames > 0:
+        step = max(1, total_frames // (num_frames * samples_per_frame))
+    else:
+        step = max(1, int(video.get(cv2.CAP_PROP_FPS) or 30))
+    max_samples = num_frames * samples_per_frame
+
+    samples = []
+    last_histogram = None
+    frame_index = 0
+    while video.grab():
+        if frame_index % step == 0:
+            ret, frame = video.retrieve()
+            if ret:
+                histogram = get_frame_histogram(frame)
+                if last_histogram is None:
+                    distance = 1.0
+                else:
+                    distance = cv2.compareHist(last_histogram, histogram, cv2.HISTCMP_BHATTACHARYYA)
+                # Near-identical samples are dropped; the rest are ranked by how much the scene changed
+                if distance >= DUPLICATE_FRAME_THRESHOLD:
+                    samples.append((frame_index, distance, resize_to_pixel_budget(frame, max_pixels)))
+                    last_histogram = histogram
+                    # Without a usable frame count (streams, broken headers) the video length is unknown,
+                    # so memory is bounded by thinning the samples and sampling half as often from here on
+                    if len(samples) > 2 * max_samples:
+                        samples = thin_samples(samples, num_frames)
+                        step *= 2
+        frame_index += 1
     video.release()
-    return key_frames
 
-
-def encode_frame(frame):
-    _, buffer = cv2.imencode('.jpg', frame)
+    if len(samples) > num_frames:
+        scene_changes = [sample for sample in samples[1:] if sample[1] >= SCENE_CHANGE_THRESHOLD]
+        if len(scene_changes) >= num_frames - 1:
+            chosen = [samples[0]] + sorted(scene_changes, key=lambda sample: -sample[1])[:num_frames - 1]
+        else:
+            # Not enough cuts: keep every cut and fill the gaps with evenly spaced samples
+            chosen = [samples[0]] + scene_changes
+            chosen_indices = {sample[0] for sample in chosen}
+            others = [sample for sample in samples if sample[0] not in chosen_indices]
+            fill = num_frames - len(chosen)
+            chosen += [others[int(i)] for i in np.linspace(0, len(others) - 1, fill)]
+        samples = sorted(chosen, key=lambda sample: sample[0])
+
+    print(f"Extracted {len(samples)} key frames from {frame_index} frames of {video_path_str}")
+    return [frame for _, _, frame in samples]
+
+
+@timed('encode')
+def encode_frame(frame, quality=None):
+    if quality is None:
+        quality = FRAME_JPEG_QUALITY
+    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
     return base64.b64encode(buffer).decode('utf-8')
 
 
 def summarize_video_frames(frames, client):
     print("Summarizing video frames")
-    encoded_frames = [encode_frame(frame) for frame in frames]
 
     system_message = """
     The assistant's job is to summarize the given video frames into 3-4 sentences. The first sentence should be an overview, and the rest should describe the main elements or features of the frame. And if the frame contains text, please include the text in the summary.
@@ -330,11 +659,24 @@ def summarize_video_frames(frames, client):
     This video is about .... The main points are: {{first phrase}}, {{second phrase}}, {{third phrase}}, ...
     \"\"\"
     """
+    model = "claude-3-haiku-20240307" if isinstance(client, anthropic.Anthropic) else "gpt-4o"
+
+    frames_hash = hashlib.sha256()
+    for frame in frames:
+        frames_hash.update(frame.tobytes())
+    cache_key = get_summary_cache_key(frames_hash.hexdigest(), 'video_frames', model, system_message)
+    cached_summary = get_cached_summary(cache_key)
+    if cached_summary:
+        print("Using cached key frames summary")
+        return cached_summary
+
+    encoded_frames = [encode_frame(frame) for frame in frames]
 
     try:
         if isinstance(client, anthropic.Anthropic):
-            message = client.messages.create(
-                model="claude-3-haiku-20240307",
+            message = call_provider(
+                client, client.messages.create,
+                model=model,
                 max_tokens=1500,
                 temperature=0.3,
                 system=system_message,
@@ -350,8 +692,9 @@ def summarize_video_frames(frames, client):
             )
             summary = message.content[0].text if message.content else None
         else:  # OpenAI
-            response = client.chat.completions.create(
-                model="gpt-4o",
+            response = call_provider(
+                client, client.chat.completions.create,
+                model=model,
                 messages=[
                     {"role": "system", "content": system_message},
                     {
@@ -367,23 +710,40 @@ def summarize_video_frames(frames, client):
             summary = response.choices[0].message.content
         
         print("Key frames summary generated")
+        store_cached_summary(cache_key, summary)
         return summary
     except Exception as e:
         print(f"API error occurred: {e}")
         return None
 
 
-def summarize_video(file_path, summarization_client, transcription_client, transcribe_function):
+def run_stages(stages, max_workers=None):
+    # Runs a small dependency graph of {name: (function, [dependencies])}; each function gets the results so far
+    results = {}
+    remaining = dict(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages)) as executor:
+        while remaining or running:
+            for name, (function, dependencies) in list(remaining.items()):
+                if all(dependency in results for dependency in dependencies):
+                    running[executor.submit(function, dict(results))] = name
+                    del remaining[name]
+            if not running:
+                raise ValueError(f"Unresolvable stage dependencies: {sorted(remaining)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    print(f"Stage {name} failed: {e}")
+                    results[name] = None
+    return results
+
+
+def summarize_video(file_path, summarization_client, transcription_client, transcribe_function, text_store=None, key_frames=None):
     print("Understanding video")
-    key_frames = extract_key_frames(file_path)
-    if not key_frames:
-        print(f"Failed to extract key frames from {file_path}")
-        return None
-
-    frames_summary = summarize_video_frames(key_frames, summarization_client)
-
-    audio_summary = summarize_audio(file_path, summarization_client, transcription_client, transcribe_function)
-
     system_message = """
     The assistant's job is to summarize the given video into 3-4 sentences by using the description of the frames and the background audio. The first sentence should be an overview, and the rest should describe the main elements or features of the video. And if the frame contains text, please include the text in the summary.
 
@@ -392,137 +752,536 @@ def summarize_video(file_path, summarization_client, transcription_client, trans
     This video is about .... The main points are: {{first phrase}}, {{second phrase}}, {{third phrase}}, ...
     \"\"\"
     """
+    model = "claude-3-5-sonnet-20240620" if isinstance(summarization_client, anthropic.Anthropic) else "gpt-4o"
 
     try:
-        if isinstance(summarization_client, anthropic.Anthropic):
-            message = summarization_client.messages.create(
-                model="claude-3-5-sonnet-20240620",
-                max_tokens=1500,
-                temperature=0.3,
-                system=system_message,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": f"Key frames summary: {frames_summary}\nBackground audio summary: {audio_summary}"
-                    }
-                ]
-            )
-            print("Video summary generated")
-            return message.content[0].text if message.content else None
-        else:
-            response = summarization_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user",
-                     "content": f"Key frames summary: {frames_summary}\nBackground audio summary: {audio_summary}"}
-                ],
-                max_tokens=300,
-            )
+        cache_key = get_summary_cache_key(hash_file(file_path), 'video', model, system_message)
+    except OSError as e:
+        print(f"Error reading video file {file_path}: {e}")
+        return None
+    cached_summary = get_cached_summary(cache_key)
+    if cached_summary:
+        print(f"Using cached video summary for: {file_path}")
+        return cached_summary
+    if key_frames is CACHED_ONLY:
+        return None
+
+    def get_key_frames(results):
+        frames = key_frames if key_frames is not None else extract_key_frames(file_path)
+        if not frames:
+            print(f"Failed to extract key frames from {file_path}")
+            return None
+        return frames
+
+    def summarize_frames(results):
+        if results['key_frames'] is None:
+            return None
+        return summarize_video_frames(results['key_frames'], summarization_client)
+
+    def summarize_background_audio(results):
+        # A video without frames gets no summary, so its audio isn't worth an upload
+        if results['key_frames'] is None:
+            return None
+        return summarize_audio(file_path, summarization_client, transcription_client, transcribe_function, text_store)
+
+    def merge_summaries(results):
+        frames_summary, audio_summary = results['frames_summary'], results['audio_summary']
+        if frames_summary is None:
+            return None
+        # '' means the video has no audio track, None that the audio branch failed
+        audio_failed = audio_summary is None
+        audio_summary = audio_summary or None
+        try:
+            if isinstance(summarization_client, anthropic.Anthropic):
+                message = call_provider(
+                    summarization_client, summarization_client.messages.create,
+                    model=model,
+                    max_tokens=1500,
+                    temperature=0.3,
+                    system=system_message,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": f"Key frames summary: {frames_summary}\nBackground audio summary: {audio_summary}"
+                        }
+                    ]
+                )
+                summary = message.content[0].text if message.content else None
+            else:
+                response = call_provider(
+                    summarization_client, summarization_client.chat.completions.create,
+                    model=model,
+                    messages=[
+                        {"role": "system", "content": system_message},
+                        {"role": "user",
+                         "content": f"Key frames summary: {frames_summary}\nBackground audio summary: {audio_summary}"}
+                    ],
+                    max_tokens=300,
+                )
+                summary = response.choices[0].message.content
+
             print("Video summary generated")
-            return response.choices[0].message.content
+            if not audio_failed:
+                store_cached_summary(cache_key, summary)
+            return summary
+        except Exception as e:
+            print(f"API error occurred: {e}")
+            return None
+
+    # Local frame extraction runs first; the frame and audio branches are then independent network-bound calls
+    results = run_stages({
+        'key_frames': (get_key_frames, []),
+        'frames_summary': (summarize_frames, ['key_frames']),
+        'audio_summary': (summarize_background_audio, ['key_frames']),
+        'video_summary': (merge_summaries, ['frames_summary', 'audio_summary'])
+    })
+    return results['video_summary']
+
+
+@timed('read')
+def hash_file(file_path, chunk_size=1024 * 1024):
+    # Memoized per (path, size, mtime) so the indexer and the summary cache hash each file once
+    stat = os.stat(file_path)
+    memo_key = (str(file_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in file_hashes:
+        return file_hashes[memo_key]
+
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    file_hashes[memo_key] = sha256.hexdigest()
+    return file_hashes[memo_key]
+
+
+def load_manifest(manifest_path):
+    if not manifest_path.is_file():
+        return {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        print(f"Loaded manifest with {len(manifest)} entries from {manifest_path}")
+        return manifest
     except Exception as e:
-        print(f"API error occurred: {e}")
+        print(f"Error reading manifest {manifest_path}, re-indexing everything: {e}")
+        return {}
+
+
+@timed('write')
+def save_manifest(manifest_path, manifest):
+    temp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, manifest_path)
+    print(f"Manifest has been saved to {manifest_path}")
+
+
+def load_journal(journal_path):
+    records = {}
+    if not journal_path.is_file():
+        return records
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                records[record['key']] = record['entry']
+            except (ValueError, KeyError):
+                continue  # A torn last line from a crash mid-write
+    print(f"Resuming from journal with {len(records)} completed summaries")
+    return records
+
+
+@timed('write')
+def append_journal_record(journal, key, entry):
+    journal.write(json.dumps({'key': key, 'entry': entry}, ensure_ascii=False) + '\n')
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def get_journal_compact_bytes():
+    try:
+        compact_bytes = int(float(JOURNAL_COMPACT_MB) * 1024 * 1024)
+    except ValueError:
+        compact_bytes = 0
+    if compact_bytes <= 0:
+        print(f"Invalid FILERAG_JOURNAL_COMPACT_MB value {JOURNAL_COMPACT_MB!r}, using 16")
+        compact_bytes = 16 * 1024 * 1024
+    return compact_bytes
+
+
+def should_compact_journal(journal, manifest_path, compact_bytes):
+    # Compacting rewrites the whole manifest, so it waits until the journal is at least half the manifest's size.
+    # That keeps the total bytes written linear in the number of files instead of quadratic
+    try:
+        manifest_bytes = manifest_path.stat().st_size
+    except OSError:
+        manifest_bytes = 0
+    return journal.tell() >= max(compact_bytes, manifest_bytes // 2)
+
+
+def compact_journal(journal, manifest_path, checkpoint):
+    # The manifest is written first, so a crash in between only replays records it already has
+    save_manifest(manifest_path, checkpoint)
+    journal.seek(0)
+    journal.truncate()
+
+
+def extract_for_summary(file_path):
+    # Runs in a worker process, so parsing, decoding and resizing don't compete with the API threads
+    suffix = file_path.suffix.lower()
+    if suffix in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
+        return prepare_image(file_path)
+    elif suffix in ['.txt', '.md', '.pdf', '.docx']:
+        return read_file_content(file_path)
+    elif suffix in ['.mp4', '.avi', '.mov', '.mkv']:
+        return extract_key_frames(file_path)
+    return None
+
+
+def extract_in_worker(file_path):
+    # The worker's own stage timings travel back with the result, since its metrics live in another process
+    extracted = extract_for_summary(file_path)
+    return extracted, get_metrics().drain_spans()
+
+
+def run_summarize(summarize, file_path, extracted=None):
+    try:
+        if extracted is None:
+            return summarize(file_path)
+        return summarize(file_path, extracted)
+    except Exception as e:
+        print(f"Error summarizing {file_path}: {e}")
         return None
 
 
-def index_folder(folder_path, summarize_document, summarize_image, summarize_audio, summarize_video):
+def summarize_pipeline(jobs, max_workers, extract_workers):
+    # CPU-heavy extraction runs in a process pool and feeds the API thread pool. At most
+    # 2 * max_workers files are in flight between the two, so memory stays flat on large folders.
+    results = queue.Queue()
+    slots = threading.BoundedSemaphore(max(1, max_workers) * 2)
+    stopped = threading.Event()
+    io_pool = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    process_pool = None
+    if extract_workers > 0:
+        process_pool = ProcessPoolExecutor(max_workers=extract_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def summarize_job(job, extracted):
+        try:
+            summary = run_summarize(job[6], job[1], extracted)
+        finally:
+            slots.release()
+        results.put((job, summary))
+
+    def on_extracted(job, future):
+        try:
+            extracted, worker_spans = future.result()
+            get_metrics().merge_spans(worker_spans)
+        except Exception as e:
+            print(f"Error extracting {job[1]} in worker process, extracting in-thread instead: {e}")
+            extracted = None
+        if not stopped.is_set():
+            io_pool.submit(summarize_job, job, extracted)
+
+    def extract_job(job):
+        # Files whose summary is already cached (e.g. duplicates of an indexed file) skip extraction entirely
+        summary = run_summarize(job[6], job[1], CACHED_ONLY)
+        if summary:
+            slots.release()
+            results.put((job, summary))
+            return
+        try:
+            process_pool.submit(extract_in_worker, job[1]).add_done_callback(functools.partial(on_extracted, job))
+            return
+        except Exception as e:
+            print(f"Extraction pool unavailable, extracting {job[1]} in-thread instead: {e}")
+        summarize_job(job, None)
+
+    def feed():
+        for job in jobs:
+            slots.acquire()
+            if stopped.is_set():
+                return
+            if process_pool is not None and job[1].suffix.lower() in EXTRACTABLE_SUFFIXES:
+                io_pool.submit(extract_job, job)
+            else:
+                io_pool.submit(summarize_job, job, None)
+
+    threading.Thread(target=feed, daemon=True).start()
+    finished = False
+    try:
+        for _ in range(len(jobs)):
+            yield results.get()
+        finished = True
+    finally:
+        stopped.set()
+        io_pool.shutdown(wait=finished, cancel_futures=not finished)
+        if process_pool is not None:
+            process_pool.shutdown(wait=finished, cancel_futures=not finished)
+
+
+def index_folder(folder_path, summarize_document, summarize_image, summarize_audio, summarize_video, manifest_path=None, max_workers=None, extract_workers=None):
+    if manifest_path is None:
+        manifest_path = folder_path / 'folder_overview.manifest.json'
+    if max_workers is None:
+        max_workers = MAX_WORKERS
+    if extract_workers is None:
+        extract_workers = EXTRACT_WORKERS
+    journal_path = manifest_path.with_name('folder_overview.journal.jsonl')
+    previous_manifest = load_manifest(manifest_path)
+    previous_manifest.update(load_journal(journal_path))
+    manifest = {}
     folder_overview = []
+    pending = []
 
     print(f"Indexing folder: {folder_path}")
-    for root, _, files in os.walk(folder_path):
-        for file in files:
+    for root, dirs, files in os.walk(folder_path):
+        # Skip the retriever's output so re-runs don't index earlier results
+        dirs[:] = sorted(d for d in dirs if d not in SKIPPED_DIRS)
+        for file in sorted(files):
             file_path = Path(root) / file
             relative_path = file_path.relative_to(folder_path)
             suffix = file_path.suffix.lower()
 
-            if suffix in ['.jpg', '.jpeg', '.png', '.gif']:
-                summary = summarize_image(file_path)
+            if suffix in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
+                summarize = summarize_image
             elif suffix in ['.txt', '.md', '.pdf', '.docx']:
-                summary = summarize_document(file_path)
+                summarize = summarize_document
             elif suffix in ['.mp3', '.wav', '.ogg', '.flac', '.aac', '.opus', '.m4a']:
-                summary = summarize_audio(file_path)
+                summarize = summarize_audio
             elif suffix in ['.mp4', '.avi', '.mov', '.mkv']:
-                summary = summarize_video(file_path)
+                summarize = summarize_video
             else:
                 continue
 
-            if summary:
-                folder_overview.append({
-                    'file_id': str(relative_path),
-                    'file_name': file,
-                    'file_path': str(relative_path),
-                    'summary': summary
-                })
-            else:
-                print(f"Failed to summarize {file_path}")
+            key = relative_path.as_posix()
+            try:
+                stat = file_path.stat()
+                cached = previous_manifest.get(key)
+                if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+                    content_hash = cached['hash']
+                else:
+                    content_hash = hash_file(file_path)
+            except OSError as e:
+                print(f"Error reading file {file_path}: {e}")
+                continue
+
+            summary = cached['summary'] if cached and cached['hash'] == content_hash else None
+            pending.append((key, file_path, relative_path, stat, content_hash, summary, summarize))
+
+    to_summarize = [job for job in pending if job[5] is None]
+    print(f"Reusing {len(pending) - len(to_summarize)} cached summaries, summarizing {len(to_summarize)} files with {max_workers} API workers and {extract_workers} extraction processes")
+
+    # Every finished summary is journaled right away, so an interrupted run can resume from it
+    summaries = {}
+    checkpoint = dict(previous_manifest)
+    journal_compact_bytes = get_journal_compact_bytes()
+    try:
+        with open(journal_path, 'a', encoding='utf-8') as journal:
+            for job, summary in summarize_pipeline(to_summarize, max_workers, extract_workers):
+                key, _, _, stat, content_hash, _, _ = job
+                summaries[key] = summary
+                if summaries[key]:
+                    checkpoint[key] = {
+                        'size': stat.st_size,
+                        'mtime': stat.st_mtime_ns,
+                        'hash': content_hash,
+                        'summary': summaries[key]
+                    }
+                    append_journal_record(journal, key, checkpoint[key])
+                    if should_compact_journal(journal, manifest_path, journal_compact_bytes):
+                        compact_journal(journal, manifest_path, checkpoint)
+    except KeyboardInterrupt:
+        print(f"Indexing interrupted, finished summaries are kept in {journal_path} and will be reused on the next run")
+        raise
+
+    # The overview is assembled in walk order, so it stays deterministic
+    for key, file_path, relative_path, stat, content_hash, summary, _ in pending:
+        if key in summaries:
+            summary = summaries[key]
+
+        if summary:
+            manifest[key] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'hash': content_hash,
+                'summary': summary
+            }
+            folder_overview.append({
+                'file_id': str(relative_path),
+                'file_name': file_path.name,
+                'file_path': str(relative_path),
+                'content_hash': content_hash,
+                'summary': summary
+            })
+        else:
+            print(f"Failed to summarize {file_path}")
+
+    removed = len(set(previous_manifest) - set(manifest))
+    print(f"Indexed {len(manifest)} files, dropped {removed} stale entries")
+    save_manifest(manifest_path, manifest)
+    journal_path.unlink(missing_ok=True)
+
+    return folder_overview
+
 
+@timed('write')
+def save_folder_overview(folder_path, folder_overview, skip_unchanged=False):
+    overview_bytes = json.dumps(folder_overview, ensure_ascii=False, indent=2).encode('utf-8')
+    version = hashlib.sha256(overview_bytes).hexdigest()
+    output_file = folder_path / 'folder_overview.json'
+    if skip_unchanged and output_file.is_file() and get_overview_version(output_file) == version:
+        print("Folder overview is unchanged")
+        return False
+
+    # The JSON overview is replaced last, so a running retriever that reloads on its change sees finished indexes
+    write_overview_store(folder_path / 'folder_overview.db', folder_overview, version)
+    bm25_index = build_bm25_index(folder_overview)
+    save_bm25_index(folder_path / 'folder_overview.bm25.json', bm25_index)
+    save_overview_tree(folder_path / 'folder_overview.tree.json', build_overview_tree(folder_overview, bm25_index))
+    save_vector_index(folder_path / 'folder_overview.vectors.npy', build_vector_index(folder_overview, EMBEDDER), folder_overview, EMBEDDER)
+
+    temp_file = output_file.with_name(output_file.name + '.tmp')
+    with open(temp_file, 'wb') as f:
+        f.write(overview_bytes)
+    os.replace(temp_file, output_file)
+    print(f"Folder overview has been saved to {output_file}")
+    return True
+
+
+def update_folder_index(folder_path, summarize_document, summarize_image, summarize_audio, summarize_video, text_store, skip_unchanged=False):
+    folder_overview = index_folder(folder_path, summarize_document, summarize_image, summarize_audio, summarize_video)
+    # An existing overview is emptied too, otherwise the retriever keeps returning files deleted since the last run
+    if folder_overview or (folder_path / 'folder_overview.json').is_file():
+        save_folder_overview(folder_path, folder_overview, skip_unchanged)
+        prune_extracted_text(text_store, {item['content_hash'] for item in folder_overview})
+    else:
+        print("No documents, images, audio files, or videos were successfully summarized.")
     return folder_overview
 
 
+def is_index_output(relative_path):
+    # The indexer's and retriever's own files, which must not trigger another re-index
+    parts = relative_path.parts
+    if not parts:
+        return False
+    return parts[0] in SKIPPED_DIRS or (len(parts) == 1 and parts[0].startswith('folder_overview.'))
+
+
+def watch_folder(folder_path, summarize_document, summarize_image, summarize_audio, summarize_video, text_store, debounce=None):
+    if debounce is None:
+        debounce = WATCH_DEBOUNCE
+    watcher = create_watcher(folder_path, is_index_output)
+    try:
+        while True:
+            # Each pass walks and stats the whole folder; only new or changed files are hashed and summarized again
+            metrics_before = get_metrics().snapshot()
+            file_hashes.clear()
+            try:
+                update_folder_index(folder_path, summarize_document, summarize_image, summarize_audio, summarize_video, text_store, skip_unchanged=True)
+            except Exception as e:
+                # A failed pass (full disk, locked store, ...) is retried on the next change instead of ending the watch
+                print(f"Error updating the index of {folder_path}, retrying on the next change: {e}")
+            print(get_metrics().format_summary("Indexing summary", metrics_before))
+            try:
+                get_metrics().export()
+            except OSError as e:
+                print(f"Error exporting metrics: {e}")
+
+            print(f"Waiting for changes in {folder_path} (Ctrl+C to stop)")
+            changes = set()
+            while not changes:
+                changes = watcher.wait()
+            # Bursts (copies, unzips, editors saving) are collected until the folder is quiet for the debounce period
+            deadline = time.monotonic() + WATCH_MAX_DELAY
+            while time.monotonic() < deadline:
+                more_changes = watcher.wait(min(debounce, max(0.0, deadline - time.monotonic())))
+                if not more_changes:
+                    break
+                changes |= more_changes
+            print(f"Detected {len(changes)} changed paths, updating the index")
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        watcher.close()
+
+
+def create_summarization_client(model_choice):
+    if model_choice == 'a':
+        return anthropic.Anthropic(api_key=get_api_key('anthropic'), max_retries=0)
+    if model_choice == 'o':
+        return OpenAI(api_key=get_api_key('openai'), max_retries=0)
+    return None
+
+
+def create_transcription(audio_api_choice, model_choice, summarization_client):
+    if audio_api_choice == 'o':
+        if model_choice == 'o':
+            transcription_client = summarization_client
+        else:
+            transcription_client = OpenAI(api_key=get_api_key('openai'), max_retries=0)
+        print("OpenAI's Audio API will be used for transcription (Whisper-V2).")
+        return transcription_client, transcribe_audio_openai
+    if audio_api_choice == 'l':
+        transcription_client = OpenAI(
+            api_key=get_api_key('lemonfox'),
+            base_url="https://api.lemonfox.ai/v1",
+            max_retries=0,
+        )
+        print("Lemonfox.ai will be used for transcription (Whisper-V3).")
+        return transcription_client, transcribe_audio_lemonfox
+    return None
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Multimodal File Indexer")
+    parser.add_argument('--provider', choices=['a', 'o'], help="'a' for Anthropic or 'o' for OpenAI for summarization")
+    parser.add_argument('--transcriber', choices=['o', 'l'], help="'o' for OpenAI or 'l' for Lemonfox.ai for audio transcription")
+    parser.add_argument('--folder', help="Folder to index")
+    parser.add_argument('--watch', action='store_true', help="Keep running and re-index when files change")
+    parser.add_argument('--debounce', type=float, default=None, help="Seconds without changes before re-indexing")
+    args = parser.parse_args()
+
     print("Welcome to the Multimodal File Indexer!")
     print("This script supports both Anthropic and OpenAI models for summarization.")
     print("For audio transcription, you can choose between OpenAI and Lemonfox.ai.")
 
-    while True:
+    model_choice = args.provider
+    summarization_client = create_summarization_client(model_choice)
+    while summarization_client is None:
         model_choice = input("Enter 'a' for Anthropic or 'o' for OpenAI for summarization: ").lower()
-
-        if model_choice == 'a':
-            api_key = get_api_key('anthropic')
-            summarization_client = anthropic.Anthropic(api_key=api_key)
-            break
-        elif model_choice == 'o':
-            api_key = get_api_key('openai')
-            summarization_client = OpenAI(api_key=api_key)
-            break
-        else:
+        summarization_client = create_summarization_client(model_choice)
+        if summarization_client is None:
             print("Invalid choice. Please enter 'a' or 'o'.")
 
-    while True:
+    transcription = create_transcription(args.transcriber, model_choice, summarization_client)
+    while transcription is None:
         audio_api_choice = input("Enter 'o' for OpenAI or 'l' for Lemonfox.ai for audio transcription: ").lower()
-
-        if audio_api_choice == 'o':
-            if model_choice == 'o':
-                transcription_client = summarization_client
-            else:
-                transcription_client = OpenAI(api_key=get_api_key('openai'))
-            transcribe_function = transcribe_audio_openai
-            print("OpenAI's Audio API will be used for transcription (Whisper-V2).")
-            break
-        elif audio_api_choice == 'l':
-            transcription_client = OpenAI(
-                api_key=get_api_key('lemonfox'),
-                base_url="https://api.lemonfox.ai/v1",
-            )
-            transcribe_function = transcribe_audio_lemonfox
-            print("Lemonfox.ai will be used for transcription (Whisper-V3).")
-            break
-        else:
+        transcription = create_transcription(audio_api_choice, model_choice, summarization_client)
+        if transcription is None:
             print("Invalid choice. Please enter 'o' or 'l'.")
+    transcription_client, transcribe_function = transcription
 
-    summarize_document_lambda = lambda file_path: summarize_document(file_path, summarization_client)
-    summarize_image_lambda = lambda file_path: summarize_image(file_path, summarization_client)
-    summarize_audio_lambda = lambda file_path: summarize_audio(file_path, summarization_client, transcription_client, transcribe_function)
-    summarize_video_lambda = lambda file_path: summarize_video(file_path, summarization_client, transcription_client, transcribe_function)
-
-    folder_path = input("Enter the folder path to index: ")
+    folder_path = args.folder or input("Enter the folder path to index: ")
     folder_path = Path(folder_path).resolve()
 
     if not folder_path.is_dir():
         print("Invalid folder path.")
         return
 
-    print(f"Starting to index folder: {folder_path}")
-    folder_overview = index_folder(folder_path, summarize_document_lambda, summarize_image_lambda, summarize_audio_lambda, summarize_video_lambda)
+    text_store = folder_path / 'folder_overview.text'
+    summarize_document_lambda = lambda file_path, file_content=None: summarize_document(file_path, summarization_client, text_store, file_content)
+    summarize_image_lambda = lambda file_path, prepared_image=None: summarize_image(file_path, summarization_client, prepared_image)
+    summarize_audio_lambda = lambda file_path: summarize_audio(file_path, summarization_client, transcription_client, transcribe_function, text_store)
+    summarize_video_lambda = lambda file_path, key_frames=None: summarize_video(file_path, summarization_client, transcription_client, transcribe_function, text_store, key_frames)
 
-    if folder_overview:
-        output_file = folder_path / 'folder_overview.json'
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(folder_overview, f, ensure_ascii=False, indent=2)
-        print(f"Folder overview has been saved to {output_file}")
-    else:
-        print("No documents, images, audio files, or videos were successfully summarized.")
+    if args.watch:
+        watch_folder(folder_path, summarize_document_lambda, summarize_image_lambda, summarize_audio_lambda, summarize_video_lambda, text_store, args.debounce)
+        return
+
+    print(f"Starting to index folder: {folder_path}")
+    update_folder_index(folder_path, summarize_document_lambda, summarize_image_lambda, summarize_audio_lambda, summarize_video_lambda, text_store)
+    print(get_metrics().format_summary("Indexing summary"))
+    get_metrics().export()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,226 @@
+import copy
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# USD per million tokens: input, output, cache read, cache write
+MODEL_PRICES = {
+    'claude-3-5-sonnet-20240620': (3.00, 15.00, 0.30, 3.75),
+    'claude-3-haiku-20240307': (0.25, 1.25, 0.03, 0.30),
+    'gpt-4o': (2.50, 10.00, 1.25, 2.50),
+    'gpt-4-turbo': (10.00, 30.00, 10.00, 10.00)
+}
+METRICS_JSONL = os.getenv('FILERAG_METRICS_JSONL')
+METRICS_PROM = os.getenv('FILERAG_METRICS_PROM')
+TOKEN_KINDS = ['input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens']
+
+
+def load_model_prices(value):
+    # A malformed setting only loses cost estimates, it must not stop the scripts from starting
+    try:
+        prices = json.loads(value)
+    except ValueError as e:
+        print(f"Ignoring FILERAG_MODEL_PRICES, it is not valid JSON: {e}")
+        return {}
+    if not isinstance(prices, dict):
+        print("Ignoring FILERAG_MODEL_PRICES, expected a JSON object mapping models to prices")
+        return {}
+    model_prices = {}
+    for model, model_price in prices.items():
+        try:
+            if len(model_price) != len(TOKEN_KINDS):
+                raise ValueError(f"expected {len(TOKEN_KINDS)} prices")
+            model_prices[model] = tuple(float(price) for price in model_price)
+        except (TypeError, ValueError) as e:
+            print(f"Ignoring FILERAG_MODEL_PRICES entry for {model}, expected [input, output, cache read, cache write]: {e}")
+    return model_prices
+
+
+MODEL_PRICES.update(load_model_prices(os.getenv('FILERAG_MODEL_PRICES', '{}')))
+
+
+def get_response_usage(response):
+    # Normalized so input_tokens never includes cached tokens, whichever provider answered
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return None
+    if hasattr(usage, 'prompt_tokens'):
+        cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None) or 0
+        return {
+            'input_tokens': (usage.prompt_tokens or 0) - cached_tokens,
+            'output_tokens': getattr(usage, 'completion_tokens', None) or 0,
+            'cache_read_tokens': cached_tokens,
+            'cache_write_tokens': 0
+        }
+    return {
+        'input_tokens': getattr(usage, 'input_tokens', None) or 0,
+        'output_tokens': getattr(usage, 'output_tokens', None) or 0,
+        'cache_read_tokens': getattr(usage, 'cache_read_input_tokens', None) or 0,
+        'cache_write_tokens': getattr(usage, 'cache_creation_input_tokens', None) or 0
+    }
+
+
+def get_cost(model, tokens):
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    return sum(tokens[kind] * price for kind, price in zip(TOKEN_KINDS, prices)) / 1_000_000
+
+
+class Metrics:
+    def __init__(self, jsonl_path=None):
+        self.jsonl_path = jsonl_path
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.models = {}
+
+    def emit(self, event):
+        if not self.jsonl_path:
+            return
+        event = {'ts': round(time.time(), 6), 'pid': os.getpid(), **event}
+        with self.lock, open(self.jsonl_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+    def add_span(self, name, seconds):
+        with self.lock:
+            stats = self.spans.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    @contextmanager
+    def span(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add_span(name, seconds)
+            self.emit({'type': 'span', 'stage': name, 'seconds': round(seconds, 6), **labels})
+
+    def record_api_call(self, model, seconds, usage=None, error=False):
+        tokens = {kind: (usage or {}).get(kind, 0) for kind in TOKEN_KINDS}
+        self.add_span('api', seconds)
+        with self.lock:
+            stats = self.models.setdefault(model, {'calls': 0, 'errors': 0, **{kind: 0 for kind in TOKEN_KINDS}})
+            stats['calls'] += 1
+            stats['errors'] += error
+            for kind in TOKEN_KINDS:
+                stats[kind] += tokens[kind]
+        self.emit({'type': 'api_call', 'model': model, 'seconds': round(seconds, 6), 'error': error, **tokens, 'cost_usd': get_cost(model, tokens)})
+
+    def drain_spans(self):
+        # Used by extraction worker processes to hand their timings back to the parent
+        with self.lock:
+            spans, self.spans = self.spans, {}
+        return spans
+
+    def merge_spans(self, spans):
+        with self.lock:
+            for name, other in spans.items():
+                stats = self.spans.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                stats['count'] += other['count']
+                stats['seconds'] += other['seconds']
+                stats['max_seconds'] = max(stats['max_seconds'], other['max_seconds'])
+
+    def snapshot(self):
+        with self.lock:
+            return {'spans': copy.deepcopy(self.spans), 'models': copy.deepcopy(self.models)}
+
+    def since(self, before=None):
+        # The counters accumulated after an earlier snapshot (max_seconds stays the overall maximum)
+        current = self.snapshot()
+        if before is None:
+            return current
+        for section in ['spans', 'models']:
+            for name, stats in current[section].items():
+                previous = before[section].get(name, {})
+                for key, value in stats.items():
+                    if key != 'max_seconds':
+                        stats[key] = value - previous.get(key, 0)
+            current[section] = {name: stats for name, stats in current[section].items() if stats.get('count', stats.get('calls'))}
+        return current
+
+    def format_summary(self, title, before=None):
+        data = self.since(before)
+        lines = [title, f"{'stage':<10} {'calls':>7} {'total s':>10} {'mean ms':>10} {'max ms':>10}"]
+        for name, stats in sorted(data['spans'].items(), key=lambda item: -item[1]['seconds']):
+            mean_ms = stats['seconds'] / stats['count'] * 1000 if stats['count'] else 0.0
+            lines.append(f"{name:<10} {stats['count']:>7} {stats['seconds']:>10.3f} {mean_ms:>10.1f} {stats['max_seconds'] * 1000:>10.1f}")
+        if data['models']:
+            lines.append(f"{'model':<28} {'calls':>6} {'errors':>6} {'input':>9} {'output':>9} {'cache rd':>9} {'cache wr':>9} {'cost $':>9}")
+            total_cost = 0.0
+            for model, stats in sorted(data['models'].items()):
+                cost = get_cost(model, stats)
+                total_cost += cost or 0.0
+                cost_text = f"{cost:>9.4f}" if cost is not None else f"{'-':>9}"
+                lines.append(
+                    f"{model:<28} {stats['calls']:>6} {stats['errors']:>6} {stats['input_tokens']:>9} {stats['output_tokens']:>9} "
+                    f"{stats['cache_read_tokens']:>9} {stats['cache_write_tokens']:>9} {cost_text}"
+                )
+            lines.append(f"Estimated cost: ${total_cost:.4f}")
+        return '\n'.join(lines)
+
+    def to_prometheus(self):
+        data = self.snapshot()
+        lines = [
+            "# HELP filerag_stage_seconds_total Time spent in each stage.",
+            "# TYPE filerag_stage_seconds_total counter"
+        ]
+        lines.extend(f'filerag_stage_seconds_total{{stage="{name}"}} {stats["seconds"]:.6f}' for name, stats in sorted(data['spans'].items()))
+        lines += ["# HELP filerag_stage_calls_total Number of timed calls of each stage.", "# TYPE filerag_stage_calls_total counter"]
+        lines.extend(f'filerag_stage_calls_total{{stage="{name}"}} {stats["count"]}' for name, stats in sorted(data['spans'].items()))
+        lines += ["# HELP filerag_stage_max_seconds Slowest single call of each stage.", "# TYPE filerag_stage_max_seconds gauge"]
+        lines.extend(f'filerag_stage_max_seconds{{stage="{name}"}} {stats["max_seconds"]:.6f}' for name, stats in sorted(data['spans'].items()))
+        lines += ["# HELP filerag_api_calls_total Provider API calls per model.", "# TYPE filerag_api_calls_total counter"]
+        lines.extend(f'filerag_api_calls_total{{model="{model}"}} {stats["calls"]}' for model, stats in sorted(data['models'].items()))
+        lines += ["# HELP filerag_api_errors_total Failed provider API calls per model.", "# TYPE filerag_api_errors_total counter"]
+        lines.extend(f'filerag_api_errors_total{{model="{model}"}} {stats["errors"]}' for model, stats in sorted(data['models'].items()))
+        lines += ["# HELP filerag_tokens_total Tokens per model and kind.", "# TYPE filerag_tokens_total counter"]
+        for model, stats in sorted(data['models'].items()):
+            lines.extend(f'filerag_tokens_total{{model="{model}",kind="{kind[:-len("_tokens")]}"}} {stats[kind]}' for kind in TOKEN_KINDS)
+        lines += ["# HELP filerag_cost_usd_total Estimated cost per model.", "# TYPE filerag_cost_usd_total counter"]
+        for model, stats in sorted(data['models'].items()):
+            cost = get_cost(model, stats)
+            if cost is not None:
+                lines.append(f'filerag_cost_usd_total{{model="{model}"}} {cost:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, prom_path=None):
+        self.emit({'type': 'summary', **self.snapshot()})
+        prom_path = prom_path or METRICS_PROM
+        if prom_path:
+            temp_path = f"{prom_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(self.to_prometheus())
+            os.replace(temp_path, prom_path)
+            print(f"Metrics have been saved to {prom_path}")
+
+
+default_metrics = None
+default_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    global default_metrics
+    with default_metrics_lock:
+        if default_metrics is None:
+            default_metrics = Metrics(METRICS_JSONL)
+        return default_metrics
+
+
+def span(name, **labels):
+    return get_metrics().span(name, **labels)
+
+
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,189 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import unicodedata
+from pathlib import Path
+from metrics import timed
+
+
+def get_overview_version(overview_path):
+    sha256 = hashlib.sha256()
+    with open(overview_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@timed('write')
+def write_overview_store(db_path, folder_overview, version=None):
+    # Built under a temporary name and swapped in, so readers never see a half-written store
+    temp_path = db_path.with_name(db_path.name + '.tmp')
+    if temp_path.exists():
+        temp_path.unlink()
+
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.execute("""
+            CREATE TABLE items (
+                position INTEGER PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                record TEXT NOT NULL
+            )
+        """)
+        connection.executemany(
+            "INSERT INTO items (position, file_id, file_name, file_path, record) VALUES (?, ?, ?, ?, ?)",
+            (
+                (position, item['file_id'], item['file_name'], item['file_path'], json.dumps(item, ensure_ascii=False))
+                for position, item in enumerate(folder_overview)
+            )
+        )
+        connection.execute("CREATE INDEX items_file_id ON items (file_id)")
+        connection.execute("CREATE INDEX items_file_name ON items (file_name)")
+        connection.execute("CREATE INDEX items_file_path ON items (file_path)")
+        # The hash of the JSON overview the store was built from, used to detect a stale store
+        connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        connection.execute("INSERT INTO meta (key, value) VALUES ('version', ?)", (version,))
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(temp_path, db_path)
+    print(f"Overview store has been saved to {db_path}")
+
+
+def get_read_only_uri(db_path):
+    # as_uri() percent-encodes '#', '?' and '%', which would otherwise end or corrupt the URI
+    return Path(db_path).resolve().as_uri() + '?mode=ro'
+
+
+class OverviewStore:
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.local = threading.local()
+        self.count = self.connection().execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        self.version = get_store_version(self.connection())
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads, so each thread opens its own
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(get_read_only_uri(self.db_path), uri=True)
+            self.local.connection = connection
+        return connection
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for (record,) in self.connection().execute("SELECT record FROM items ORDER BY position"):
+            yield json.loads(record)
+
+    def get(self, file_id):
+        connection = self.connection()
+        for column in ['file_id', 'file_path', 'file_name']:
+            row = connection.execute(
+                f"SELECT record FROM items WHERE {column} = ? ORDER BY position LIMIT 1", (file_id,)
+            ).fetchone()
+            if row:
+                return json.loads(row[0])
+        return None
+
+    def get_many(self, file_ids):
+        items = []
+        for file_id in file_ids:
+            item = self.get(file_id)
+            if item is not None:
+                items.append(item)
+        return items
+
+
+def get_store_version(connection):
+    try:
+        row = connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+def read_store_version(db_path):
+    if not db_path.is_file():
+        return None
+    try:
+        connection = sqlite3.connect(get_read_only_uri(db_path), uri=True)
+    except sqlite3.Error:
+        return None
+    try:
+        return get_store_version(connection)
+    finally:
+        connection.close()
+
+
+def open_overview_store(overview_path, version=None):
+    if version is None:
+        version = get_overview_version(overview_path)
+    db_path = overview_path.with_suffix('.db')
+    if read_store_version(db_path) != version:
+        # Older indexes only have the JSON overview, so build the store from it once
+        print(f"Building overview store from {overview_path}")
+        with open(overview_path, 'r', encoding='utf-8') as f:
+            folder_overview = json.load(f)
+        try:
+            write_overview_store(db_path, folder_overview, version)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Cannot write overview store next to {overview_path}, using a temporary copy: {e}")
+            db_path = Path(tempfile.mkdtemp(prefix='filerag_')) / db_path.name
+            write_overview_store(db_path, folder_overview, version)
+    return OverviewStore(db_path)
+
+
+def normalize_text(text):
+    text = unicodedata.normalize('NFC', text).replace('\r\n', '\n').replace('\r', '\n')
+    lines = [line.rstrip() for line in text.split('\n')]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+
+def get_text_path(text_store, content_hash):
+    return text_store / content_hash[:2] / f"{content_hash}.txt.gz"
+
+
+def has_extracted_text(text_store, content_hash):
+    return get_text_path(text_store, content_hash).is_file()
+
+
+@timed('write')
+def write_extracted_text(text_store, content_hash, text):
+    # Keyed by the source file's content hash, so identical files share one entry
+    text_path = get_text_path(text_store, content_hash)
+    if text_path.is_file():
+        return
+    text_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = text_path.with_name(f"{text_path.name}.{threading.get_ident()}.tmp")
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        f.write(normalize_text(text))
+    os.replace(temp_path, text_path)
+
+
+@timed('read')
+def read_extracted_text(text_store, content_hash):
+    try:
+        with gzip.open(get_text_path(text_store, content_hash), 'rt', encoding='utf-8') as f:
+            return f.read()
+    except (OSError, EOFError):
+        return None
+
+
+def prune_extracted_text(text_store, content_hashes):
+    removed = 0
+    for text_path in text_store.glob('*/*.txt.gz'):
+        if text_path.name[:-len('.txt.gz')] not in content_hashes:
+            text_path.unlink()
+            removed += 1
+    if removed:
+        print(f"Removed {removed} stale entries from the extracted text store")
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+class QueryCache:
+    def __init__(self, db_path, ttl_seconds=86400, max_entries=1000):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self.connection() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS queries (
+                    cache_key TEXT PRIMARY KEY,
+                    file_ids TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS queries_last_used ON queries (last_used)")
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            self.local.connection = connection
+        return connection
+
+    def make_key(self, query, overview_version, model):
+        # The overview version is part of the key, so re-indexing invalidates every cached answer
+        return hashlib.sha256(f"{normalize_query(query)}|{overview_version}|{model}".encode('utf-8')).hexdigest()
+
+    def get(self, query, overview_version, model):
+        cache_key = self.make_key(query, overview_version, model)
+        now = time.time()
+        with self.connection() as connection:
+            row = connection.execute("SELECT file_ids, created FROM queries WHERE cache_key = ?", (cache_key,)).fetchone()
+            if row and now - row[1] <= self.ttl_seconds:
+                connection.execute("UPDATE queries SET last_used = ? WHERE cache_key = ?", (now, cache_key))
+            elif row:
+                connection.execute("DELETE FROM queries WHERE cache_key = ?", (cache_key,))
+                row = None
+
+        with self.lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if row:
+            print(f"Query cache hit for: {query}")
+            return json.loads(row[0])
+        return None
+
+    def put(self, query, overview_version, model, file_ids):
+        cache_key = self.make_key(query, overview_version, model)
+        now = time.time()
+        with self.connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO queries (cache_key, file_ids, created, last_used) VALUES (?, ?, ?, ?)",
+                (cache_key, json.dumps(file_ids, ensure_ascii=False), now, now)
+            )
+            # Least recently used entries beyond the size limit are evicted
+            connection.execute(
+                "DELETE FROM queries WHERE cache_key IN (SELECT cache_key FROM queries ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
@@ -1,6 +1,8 @@
+import argparse
 import base64
 import json
 import shutil
+import time
 from pathlib import Path
 import anthropic
 import cv2
@@ -10,6 +12,36 @@ import datetime
 import docx
 import PyPDF2
 import re
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from overview_store import get_overview_version, open_overview_store, read_extracted_text
+from query_cache import QueryCache
+from scheduler import call_provider, estimate_text_tokens
+from metrics import get_metrics, get_response_usage, span, timed
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from search_index import load_bm25_index, bm25_search, has_missing_terms, load_vector_index, vector_search, load_overview_tree, route_query
+
+RETRIEVAL_TOP_K = int(os.getenv('FILERAG_TOP_K', '50'))
+TREE_ROUTING_MIN_ITEMS = int(os.getenv('FILERAG_TREE_MIN_ITEMS', '5000'))
+TREE_BEAM_WIDTH = int(os.getenv('FILERAG_TREE_BEAM', '3'))
+QUERY_CACHE_TTL = int(os.getenv('FILERAG_QUERY_CACHE_TTL', '86400'))
+QUERY_CACHE_SIZE = int(os.getenv('FILERAG_QUERY_CACHE_SIZE', '1000'))
+MATERIALIZE_MODE = os.getenv('FILERAG_MATERIALIZE', 'reflink')
+FICLONE = 0x40049409
+PROMPT_TOKEN_BUDGET = int(os.getenv('FILERAG_PROMPT_TOKEN_BUDGET', '100000'))
+SHARD_TOKENS = int(os.getenv('FILERAG_SHARD_TOKENS', str(PROMPT_TOKEN_BUDGET)))
+SHARD_FANOUT = int(os.getenv('FILERAG_SHARD_FANOUT', '8'))
+SHARD_RERANK = os.getenv('FILERAG_SHARD_RERANK', '0') == '1'
+RELOAD_CHECK_INTERVAL = float(os.getenv('FILERAG_RELOAD_INTERVAL', '2'))
+ANTHROPIC_MODEL = "claude-3-5-sonnet-20240620"
+OPENAI_MODEL = "gpt-4o"
 
 
 def get_api_key(api_name):
@@ -33,12 +65,72 @@ def get_api_key(api_name):
     return api_key
 
 
-def load_folder_overview(overview_path):
+def load_folder_overview(overview_path, version=None):
     print(f"Loading folder overview from {overview_path}")
-    with open(overview_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    print(f"Loaded {len(data)} items from folder overview")
-    return data
+    store = open_overview_store(overview_path, version)
+    print(f"Loaded {len(store)} items from folder overview")
+    return store
+
+
+def load_retrieval_index(overview_path):
+    # The mtime is taken before reading, so a rewrite that lands mid-load triggers another reload
+    mtime = overview_path.stat().st_mtime_ns
+    version = get_overview_version(overview_path)
+    return {
+        'overview_path': overview_path,
+        'folder_path': overview_path.parent,
+        'mtime': mtime,
+        'version': version,
+        'folder_overview': load_folder_overview(overview_path, version),
+        'bm25_index': load_bm25_index(overview_path.with_name('folder_overview.bm25.json')),
+        'vector_index': load_vector_index(overview_path.with_name('folder_overview.vectors.npy')),
+        'overview_tree': load_overview_tree(overview_path.with_name('folder_overview.tree.json'))
+    }
+
+
+def search_rankings(query, bm25_index, vector_index, top_k, restrict_to=None):
+    rankings = []
+    if bm25_index is not None:
+        rankings.append(bm25_search(bm25_index, query, top_k, restrict_to=restrict_to))
+    if vector_index is not None:
+        rankings.append(vector_search(vector_index, query, top_k, restrict_to=restrict_to))
+    return rankings
+
+
+@timed('search')
+def select_candidates(query, folder_overview, bm25_index, vector_index=None, overview_tree=None, top_k=None):
+    if top_k is None:
+        top_k = RETRIEVAL_TOP_K
+    if (bm25_index is None and vector_index is None) or len(folder_overview) <= top_k:
+        return list(folder_overview)
+
+    # On very large folders, descend the directory tree first and only rank files in the chosen folders
+    routed_files = None
+    if overview_tree is not None and len(folder_overview) >= TREE_ROUTING_MIN_ITEMS:
+        routed_files = set(route_query(overview_tree, query, TREE_BEAM_WIDTH)) or None
+
+    rankings = search_rankings(query, bm25_index, vector_index, top_k, routed_files)
+    if routed_files is not None:
+        # Folder terms are truncated as they roll up the tree, so routing can miss files with rare query terms
+        too_few_matches = len({file_id for ranking in rankings for file_id, _ in ranking}) < top_k
+        if too_few_matches or (bm25_index is not None and has_missing_terms(bm25_index, query, routed_files)):
+            print("The routed folders miss some of the query, searching the whole folder")
+            rankings = search_rankings(query, bm25_index, vector_index, top_k)
+    if not any(rankings):
+        # Sending the whole folder instead would cost one call per shard across the entire corpus
+        print("No lexical or vector matches for the query")
+        return []
+
+    # Reciprocal rank fusion of the lexical and vector shortlists
+    fused_scores = {}
+    for ranking in rankings:
+        for rank, (file_id, _) in enumerate(ranking):
+            fused_scores[file_id] = fused_scores.get(file_id, 0.0) + 1.0 / (60 + rank)
+    ranked_ids = sorted(fused_scores, key=lambda file_id: -fused_scores[file_id])[:top_k]
+
+    candidates = folder_overview.get_many(ranked_ids)
+    print(f"Selected {len(candidates)} of {len(folder_overview)} items with BM25 and vector search")
+    return candidates
 
 
 def create_results_folders(base_folder):
@@ -64,9 +156,12 @@ def create_results_folders(base_folder):
     return filerag_results, session_folder, image_results, text_results, audio_results, video_results
 
 
+log_lock = threading.Lock()
+
+
 def log_api_response(response, query, log_file):
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(log_file, 'a', encoding='utf-8') as f:
+    with log_lock, open(log_file, 'a', encoding='utf-8') as f:
         f.write(f"\n--- API Response Log: {timestamp} ---\n")
         f.write(f"Query: {query}\n")
         f.write(f"Response: {response}\n")
@@ -74,7 +169,8 @@ def log_api_response(response, query, log_file):
     print(f"API response logged to {log_file}")
 
 
-def parse_file_ids(response_content):
+@timed('parse')
+def parse_file_ids(response_content, id_table):
     print("Parsing file IDs from API response")
     print(f"Raw response: {response_content}")
 
@@ -83,27 +179,71 @@ def parse_file_ids(response_content):
     try:
         response_json = json.loads(cleaned_response)
 
-        if 'file_id' in response_json:
-            file_ids = response_json['file_id'].split(',')
-
-            normalized_file_ids = [Path(file_id.strip()).name for file_id in file_ids]
-
-            print(f"Parsed and normalized file IDs: {normalized_file_ids}")
-            return normalized_file_ids
+        if isinstance(response_json, dict):
+            if 'file_id' not in response_json:
+                print("No 'file_id' key found in the JSON response")
+                return []
+            response_json = response_json['file_id']
+        # Models answer with "1,3", [1, 3] or a bare 3 alike
+        if isinstance(response_json, list):
+            file_ids = [str(file_id) for file_id in response_json if not isinstance(file_id, (dict, list))]
+        elif isinstance(response_json, (str, int, float)) and not isinstance(response_json, bool):
+            file_ids = str(response_json).split(',')
         else:
-            print("No 'file_id' key found in the JSON response")
+            print(f"Unexpected file IDs in the JSON response: {response_json}")
             return []
 
     except json.JSONDecodeError as e:
         print(f"Failed to parse JSON: {e}")
         print("Falling back to regex method")
-        file_id_tuples = re.findall(r'"([^"]+\.(md|pdf|txt|docx))"', response_content)
-        file_ids = [Path(file_id[0]).name for file_id in file_id_tuples]
-        print(f"Parsed and normalized file IDs (regex method): {file_ids}")
-        return file_ids
+        match = re.search(r'"file_id"\s*:\s*("[^"]*|\[[^\]]*|\d+)', response_content)
+        file_ids = re.findall(r'[^\s",\[]+', match.group(1)) if match else []
+
+    # Short IDs index straight into the table of the prompt they were sent in
+    resolved_file_ids = []
+    for short_id in file_ids:
+        short_id = short_id.strip()
+        if short_id.isdigit() and 1 <= int(short_id) <= len(id_table):
+            if id_table[int(short_id) - 1] not in resolved_file_ids:
+                resolved_file_ids.append(id_table[int(short_id) - 1])
+        elif short_id:
+            print(f"Ignoring unknown file ID in the response: {short_id}")
+    print(f"Parsed and resolved file IDs: {resolved_file_ids}")
+    return resolved_file_ids
+
+
+def get_overview_line(short_id, item):
+    summary = ' '.join(str(item.get('summary', '')).split())
+    return f"{short_id}|{item['file_path']}|{summary}"
+
+
+def pack_overview(folder_overview, token_budget=None):
+    # One 'id|path|summary' line per file: short integer IDs instead of repeated paths, and no JSON whitespace
+    if token_budget is None:
+        token_budget = PROMPT_TOKEN_BUDGET
+    lines = ["id|path|summary"]
+    id_table = []
+    used_tokens = estimate_text_tokens(lines[0])
+    skipped = 0
+    for item in folder_overview:
+        line = get_overview_line(len(id_table) + 1, item)
+        line_tokens = estimate_text_tokens(line) + 1
+        if used_tokens + line_tokens > token_budget:
+            skipped += 1
+            continue
+        lines.append(line)
+        id_table.append(item['file_id'])
+        used_tokens += line_tokens
+
+    if skipped:
+        print(f"Packed {len(id_table)} items into about {used_tokens} tokens, {skipped} items did not fit the {token_budget} token budget")
+    else:
+        print(f"Packed {len(id_table)} items into about {used_tokens} tokens")
+    return '\n'.join(lines), id_table
 
 
-def extract_pdf_content(pdf_path, max_pages=1):
+@timed('extract')
+def extract_pdf_content(pdf_path, max_pages=5):
     with open(pdf_path, 'rb') as file:
         reader = PyPDF2.PdfReader(file)
         content = ""
@@ -112,117 +252,215 @@ def extract_pdf_content(pdf_path, max_pages=1):
     return content
 
 
-def process_query_anthropic(query, folder_overview, client, log_file):
+def record_usage(usage, response):
+    # Normalized by metrics, so input_tokens excludes cached tokens for both providers
+    response_usage = get_response_usage(response)
+    if response_usage is None:
+        return
+    print(f"Prompt cache: {response_usage['cache_read_tokens']} tokens read, {response_usage['cache_write_tokens']} tokens written")
+    if usage is not None:
+        usage.update(response_usage)
+
+
+def process_query_anthropic(query, folder_overview, client, log_file, usage=None):
     system_message = """
-    The assistant's job is to pick the best file(s) that match(es) the given query using the file name and the file summary. If there is multiple file, use comma to seperate. It only need to return the file id in a JSON format. It should not miss any file that is related to the query. It *MUST* only return the JSON string without any other text, or it will be considered as an error. Do not put the JSON string inside the triple backticks, or it will be considered as an error.
+    The assistant's job is to pick the best file(s) that match(es) the given query using the file path and the file summary. Each line of the folder overview describes one file as "id|path|summary". If there is multiple file, use comma to seperate. It only need to return the numeric file id in a JSON format. It should not miss any file that is related to the query. It *MUST* only return the JSON string without any other text, or it will be considered as an error. Do not put the JSON string inside the triple backticks, or it will be considered as an error.
     Reminder: The description of the audio file might be affected by the original transcription, so it might have recognition errors; DO NOT be strict with the audio file.
     Example output format (It must follow this format, or it will be considered as an error):
     \"\"\"
     {
-        "file_id": "file_id1,file_id2,...“
+        "file_id": "3,17,42"
     }
     \"\"\"
     """
     try:
+        overview_text, id_table = pack_overview(folder_overview)
         print("Sending request to Anthropic API")
-        message = client.messages.create(
-            model="claude-3-5-sonnet-20240620",
+        message = call_provider(
+            client, client.messages.create,
+            model=ANTHROPIC_MODEL,
             max_tokens=1000,
             temperature=0.5,
             system=system_message,
             messages=[
                 {
                     "role": "user",
-                    "content": f"Query: {query}\n\nFolder overview:\n{json.dumps(folder_overview, ensure_ascii=False, indent=2)}"
+                    "content": [
+                        # Everything up to and including the overview block is cached, the query comes after it
+                        {
+                            "type": "text",
+                            "text": f"Folder overview:\n{overview_text}",
+                            "cache_control": {"type": "ephemeral"}
+                        },
+                        {"type": "text", "text": f"Query: {query}"}
+                    ]
                 }
             ]
         )
 
         response_content = message.content[0].text if message.content else None
         print(f"Received API response: {response_content}")
+        record_usage(usage, message)
         log_api_response(response_content, query, log_file)
 
         if response_content:
-            return parse_file_ids(response_content)
+            return parse_file_ids(response_content, id_table)
         else:
             print("Error: Empty response from the API.")
             return []
     except anthropic.APIError as e:
         print(f"API error occurred: {e}")
         log_api_response(str(e), query, log_file)
+        if usage is not None:
+            usage['error'] = str(e)
         return []
 
 
-def process_query_openai(query, folder_overview, client, log_file):
+def process_query_openai(query, folder_overview, client, log_file, usage=None):
     system_message = """
-    The assistant's job is to pick the best file(s) that match(es) the given query using the file name and the file summary. If there is multiple file, use comma to seperate. It only need to return the file id in a JSON format. It should not miss any file that is related to the query. It *MUST* only return the JSON string without any other text, or it will be considered as an error. Do not put the JSON string inside the triple backticks, or it will be considered as an error.
+    The assistant's job is to pick the best file(s) that match(es) the given query using the file path and the file summary. Each line of the folder overview describes one file as "id|path|summary". If there is multiple file, use comma to seperate. It only need to return the numeric file id in a JSON format. It should not miss any file that is related to the query. It *MUST* only return the JSON string without any other text, or it will be considered as an error. Do not put the JSON string inside the triple backticks, or it will be considered as an error.
     Reminder: The description of the audio file might be affected by the original transcription, so it might have recognition errors; DO NOT be strict with the audio file.
     Example output format (It must follow this format, or it will be considered as an error):
     \"\"\"
     {
-        "file_id": "file_id1,file_id2,...“
+        "file_id": "3,17,42"
     }
     \"\"\"
     """
     try:
+        overview_text, id_table = pack_overview(folder_overview)
         print("Sending request to OpenAI API")
-        completion = client.chat.completions.create(
-            model="gpt-4o",
+        # OpenAI caches shared prompt prefixes automatically; the key routes requests with the same overview together
+        completion = call_provider(
+            client, client.chat.completions.create,
+            model=OPENAI_MODEL,
             messages=[
                 {"role": "system", "content": system_message},
                 {"role": "user",
-                 "content": f"Query: {query}\n\nFolder overview:\n{json.dumps(folder_overview, ensure_ascii=False, indent=2)}"}
-            ]
+                 "content": f"Folder overview:\n{overview_text}\n\nQuery: {query}"}
+            ],
+            extra_body={"prompt_cache_key": f"filerag-{hashlib.sha256(overview_text.encode('utf-8')).hexdigest()[:32]}"}
         )
 
         response_content = completion.choices[0].message.content
         print(f"Received API response: {response_content}")
+        record_usage(usage, completion)
         log_api_response(response_content, query, log_file)
 
         if response_content:
-            return parse_file_ids(response_content)
+            return parse_file_ids(response_content, id_table)
         else:
             print("Error: Empty response from the API.")
             return []
     except Exception as e:
         print(f"API error occurred: {e}")
         log_api_response(str(e), query, log_file)
+        if usage is not None:
+            usage['error'] = str(e)
         return []
 
 
+def split_overview(folder_overview, shard_tokens):
+    # Sized with the widest ID of the whole list, so every shard still fits once pack_overview numbers it
+    folder_overview = list(folder_overview)
+    widest_id = len(folder_overview)
+    shards = [[]]
+    shard_used = estimate_text_tokens("id|path|summary")
+    for item in folder_overview:
+        line_tokens = estimate_text_tokens(get_overview_line(widest_id, item)) + 1
+        if shards[-1] and shard_used + line_tokens > shard_tokens:
+            shards.append([])
+            shard_used = estimate_text_tokens("id|path|summary")
+        shards[-1].append(item)
+        shard_used += line_tokens
+    return shards
+
+
+def process_query_sharded(process_query, query, folder_overview, client, log_file, usage=None):
+    shards = split_overview(folder_overview, SHARD_TOKENS)
+    if len(shards) <= 1:
+        return process_query(query, folder_overview, client, log_file, usage)
+
+    # Map: every shard is asked on its own, concurrently; reduce: merge the picks in shard order
+    print(f"Splitting {len(folder_overview)} items into {len(shards)} shards of up to {SHARD_TOKENS} tokens")
+    shard_usages = [{} for _ in shards]
+    with ThreadPoolExecutor(max_workers=min(SHARD_FANOUT, len(shards))) as executor:
+        shard_file_ids = list(executor.map(
+            lambda shard, shard_usage: process_query(query, shard, client, log_file, shard_usage),
+            shards, shard_usages
+        ))
+
+    file_ids = []
+    for shard_ids in shard_file_ids:
+        for file_id in shard_ids:
+            if file_id not in file_ids:
+                file_ids.append(file_id)
+    failed_shards = sum('error' in shard_usage for shard_usage in shard_usages)
+    if failed_shards:
+        print(f"{failed_shards} of {len(shards)} shards failed")
+    print(f"Merged {len(file_ids)} file IDs from {len(shards)} shards")
+
+    if SHARD_RERANK and len(file_ids) > 1:
+        items = {item['file_id']: item for shard in shards for item in shard}
+        rerank_usage = {}
+        reranked_ids = process_query(query, [items[file_id] for file_id in file_ids if file_id in items], client, log_file, rerank_usage)
+        shard_usages.append(rerank_usage)
+        if reranked_ids:
+            print(f"Rerank kept {len(reranked_ids)} of {len(file_ids)} merged file IDs")
+            file_ids = reranked_ids
+        else:
+            print("Rerank returned nothing, keeping the merged file IDs")
+
+    if usage is not None:
+        for key in ['input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens']:
+            usage[key] = sum(shard_usage.get(key, 0) for shard_usage in shard_usages)
+        if failed_shards == len(shards):
+            usage['error'] = shard_usages[0]['error']
+    return file_ids
+
+
 def retrieve_document(file_id, folder_path, folder_overview):
     print(f"Retrieving document: {file_id}")
-    for item in folder_overview:
-        if file_id in [item['file_id'], item['file_name'], Path(item['file_path']).name]:
-            full_path = folder_path / item['file_path']
-            try:
-                if full_path.suffix.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
-                    print(f"Image file found: {full_path}")
-                    return str(full_path), "<<image_file>>"
-                elif full_path.suffix.lower() in ['.mp3', '.wav', '.ogg', '.flac', '.aac', '.opus', '.m4a']:
-                    print(f"Audio file found: {full_path}")
-                    return str(full_path), "<<audio_file>>"
-                elif full_path.suffix.lower() in ['.mp4', '.avi', '.mov', '.mkv']:
-                    print(f"Video file found: {full_path}")
-                    return str(full_path), "<<video_file>>"
-                elif full_path.suffix.lower() == '.pdf':
-                    content = extract_pdf_content(full_path)
-                    print(f"PDF file content retrieved: {full_path}")
-                elif full_path.suffix.lower() == '.docx':
-                    content = extract_docx_content(full_path)
-                    print(f"Word file content retrieved: {full_path}")
-                else:
-                    with open(full_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    print(f"Text file content retrieved: {full_path}")
-                return str(full_path), content
-            except Exception as e:
-                print(f"Error reading file {full_path}: {e}")
-                return str(full_path), f"<<Error reading file: {e}>>"
-    print(f"File ID {file_id} not found in folder overview")
-    return None, None
+    item = folder_overview.get(file_id)
+    if item is None:
+        print(f"File ID {file_id} not found in folder overview")
+        return None, None
+
+    full_path = folder_path / item['file_path']
+    # Text extracted at index time is served from the sidecar store instead of re-parsing the file
+    if item.get('content_hash') and full_path.suffix.lower() in ['.pdf', '.docx', '.txt', '.md']:
+        content = read_extracted_text(folder_path / 'folder_overview.text', item['content_hash'])
+        if content is not None:
+            print(f"Indexed text content retrieved: {full_path}")
+            return str(full_path), content
+
+    try:
+        if full_path.suffix.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
+            print(f"Image file found: {full_path}")
+            return str(full_path), "<<image_file>>"
+        elif full_path.suffix.lower() in ['.mp3', '.wav', '.ogg', '.flac', '.aac', '.opus', '.m4a']:
+            print(f"Audio file found: {full_path}")
+            return str(full_path), "<<audio_file>>"
+        elif full_path.suffix.lower() in ['.mp4', '.avi', '.mov', '.mkv']:
+            print(f"Video file found: {full_path}")
+            return str(full_path), "<<video_file>>"
+        elif full_path.suffix.lower() == '.pdf':
+            content = extract_pdf_content(full_path)
+            print(f"PDF file content retrieved: {full_path}")
+        elif full_path.suffix.lower() == '.docx':
+            content = extract_docx_content(full_path)
+            print(f"Word file content retrieved: {full_path}")
+        else:
+            with span('read'), open(full_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            print(f"Text file content retrieved: {full_path}")
+        return str(full_path), content
+    except Exception as e:
+        print(f"Error reading file {full_path}: {e}")
+        return str(full_path), f"<<Error reading file: {e}>>"
 
 
+@timed('extract')
 def extract_docx_content(docx_path):
     try:
         doc = docx.Document(docx_path)
@@ -235,15 +473,92 @@ def extract_docx_content(docx_path):
         return "<<Error reading Word file>>"
 
 
-def write_results(results, session_folder, is_image=False, is_audio=False, is_video=False):
+def reflink_file(source, destination):
+    # Copy-on-write clone (Btrfs, XFS, ...); falls back to a regular copy where unsupported
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(destination, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, destination)
+
+
+def hardlink_file(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class ResultMaterializer:
+    def __init__(self, mode=None, max_workers=2):
+        self.mode = mode or MATERIALIZE_MODE
+        if self.mode not in ['copy', 'reflink', 'hardlink', 'symlink', 'manifest']:
+            raise ValueError(f"Unknown materialization mode: {self.mode}")
+        self.materialized = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+
+    def materialize(self, source, destination):
+        source = Path(source).resolve()
+        with self.lock:
+            if source in self.materialized:
+                print(f"Already materialized in this session: {self.materialized[source]}")
+                return self.materialized[source]
+            self.materialized[source] = destination
+
+        if self.mode == 'symlink':
+            destination.unlink(missing_ok=True)
+            destination.symlink_to(source)
+        elif self.mode == 'hardlink':
+            destination.unlink(missing_ok=True)
+            self.futures.append(self.executor.submit(hardlink_file, source, destination))
+        elif self.mode == 'reflink':
+            self.futures.append(self.executor.submit(reflink_file, source, destination))
+        elif self.mode == 'copy':
+            self.futures.append(self.executor.submit(shutil.copy2, source, destination))
+        return destination
+
+    def wait(self):
+        for future in self.futures:
+            try:
+                future.result()
+            except OSError as e:
+                print(f"Error materializing result file: {e}")
+        self.futures = []
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+@timed('write')
+def write_results(results, session_folder, is_image=False, is_audio=False, is_video=False, materializer=None, query=None):
     if is_image or is_audio or is_video:
         result_folder = session_folder / (
             'image_results' if is_image else 'audio_results' if is_audio else 'video_results')
+        if materializer is not None and materializer.mode == 'manifest':
+            # Every query of the session appends here, so each line says which query it ranks for
+            timestamp = datetime.datetime.now().isoformat(timespec='seconds')
+            with open(result_folder / 'manifest.jsonl', 'a', encoding='utf-8') as f:
+                for i, (file_path, _) in enumerate(results, 1):
+                    record = {'timestamp': timestamp, 'query': query, 'rank': i, 'file_path': str(file_path)}
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            print(f"{'Image' if is_image else 'Audio' if is_audio else 'Video'} results listed in {result_folder / 'manifest.jsonl'}")
+            return
+
         for i, (file_path, _) in enumerate(results, 1):
             original_file = Path(file_path)
             new_file_name = f"{i}_{original_file.name}"
-            shutil.copy2(original_file, result_folder / new_file_name)
-        print(f"{'Image' if is_image else 'Audio' if is_audio else 'Video'} results copied to {result_folder}")
+            if materializer is None:
+                shutil.copy2(original_file, result_folder / new_file_name)
+            else:
+                materializer.materialize(original_file, result_folder / new_file_name)
+        print(f"{'Image' if is_image else 'Audio' if is_audio else 'Video'} results materialized in {result_folder}")
     else:
         output_file = session_folder / 'text_results' / 'retrieved_text_results.txt'
         with open(output_file, 'w', encoding='utf-8') as f:
@@ -268,81 +583,360 @@ def extract_video_frame(video_path, frame_number=0):
     return None
 
 
+def get_result_type(content):
+    return {'<<image_file>>': 'image', '<<audio_file>>': 'audio', '<<video_file>>': 'video'}.get(content, 'text')
+
+
+def answer_query(query, index, client, process_query, model, log_file, query_cache=None, usage=None):
+    cache_model = f"{model}|top_k={RETRIEVAL_TOP_K}|budget={PROMPT_TOKEN_BUDGET}|shard={SHARD_TOKENS}|rerank={SHARD_RERANK}"
+    file_ids = None
+    if query_cache is not None:
+        file_ids = query_cache.get(query, index['version'], cache_model)
+    if usage is not None:
+        usage['cache_hit'] = file_ids is not None
+    if file_ids is None:
+        candidates = select_candidates(query, index['folder_overview'], index['bm25_index'], index['vector_index'], index['overview_tree'])
+        file_ids = process_query_sharded(process_query, query, candidates, client, log_file, usage) if candidates else []
+        if file_ids and query_cache is not None:
+            query_cache.put(query, index['version'], cache_model, file_ids)
+    print(f"File IDs returned by process_query: {file_ids}")
+    return file_ids
+
+
+def run_query(query, index, client, process_query, model, log_file, query_cache=None):
+    file_ids = answer_query(query, index, client, process_query, model, log_file, query_cache)
+
+    results = []
+    for file_id in file_ids:
+        retrieved_path, content = retrieve_document(file_id, index['folder_path'], index['folder_overview'])
+        if retrieved_path:
+            results.append((file_id, retrieved_path, content))
+            print(f"Retrieved document: {retrieved_path}")
+        else:
+            print(f"Error: Unable to retrieve the document with file ID: {file_id}")
+    return file_ids, results
+
+
+class OverviewReloader:
+    def __init__(self, overview_path, check_interval=None):
+        self.overview_path = overview_path
+        self.check_interval = RELOAD_CHECK_INTERVAL if check_interval is None else check_interval
+        self.index = load_retrieval_index(overview_path)
+        self.checked = time.monotonic()
+        self.lock = threading.Lock()
+
+    def current(self):
+        if time.monotonic() - self.checked < self.check_interval:
+            return self.index
+        # Only one request reloads; the others keep answering from the index they already have
+        if not self.lock.acquire(blocking=False):
+            return self.index
+        try:
+            self.checked = time.monotonic()
+            try:
+                mtime = self.overview_path.stat().st_mtime_ns
+            except OSError as e:
+                print(f"Cannot stat {self.overview_path}, keeping the loaded overview: {e}")
+                return self.index
+            if mtime != self.index['mtime']:
+                print(f"{self.overview_path} has changed, reloading")
+                try:
+                    self.index = load_retrieval_index(self.overview_path)
+                except Exception as e:
+                    print(f"Error reloading {self.overview_path}, keeping the loaded overview: {e}")
+            return self.index
+        finally:
+            self.lock.release()
+
+
+def make_request_handler(reloader, client, process_query, model, log_file, query_cache):
+    class RetrievalRequestHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/health':
+                index = reloader.current()
+                self.send_json(200, {'status': 'ok', 'items': len(index['folder_overview']), 'overview_version': index['version']})
+            elif url.path == '/query':
+                self.handle_query(parse_qs(url.query).get('q', [''])[0])
+            elif url.path == '/metrics':
+                body = get_metrics().to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_json(404, {'error': f"Unknown path: {url.path}"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/query':
+                self.send_json(404, {'error': f"Unknown path: {url.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                query = body.get('query', '')
+            except (ValueError, AttributeError):
+                self.send_json(400, {'error': "Request body must be a JSON object with a 'query' field"})
+                return
+            self.handle_query(query)
+
+        def handle_query(self, query):
+            if not isinstance(query, str) or not query.strip():
+                self.send_json(400, {'error': "Missing query"})
+                return
+            start = time.perf_counter()
+            try:
+                index = reloader.current()
+                file_ids, results = run_query(query, index, client, process_query, model, log_file, query_cache)
+            except Exception as e:
+                print(f"Error processing query {query!r}: {e}")
+                self.send_json(500, {'error': str(e)})
+                return
+            self.send_json(200, {
+                'query': query,
+                'overview_version': index['version'],
+                'file_ids': file_ids,
+                'results': [
+                    {
+                        'file_id': file_id,
+                        'file_path': file_path,
+                        'type': get_result_type(content),
+                        'content': content if get_result_type(content) == 'text' else None
+                    }
+                    for file_id, file_path, content in results
+                ],
+                'latency_ms': round((time.perf_counter() - start) * 1000, 1)
+            })
+
+    return RetrievalRequestHandler
+
+
+def serve(overview_path, client, process_query, model, host='127.0.0.1', port=8000):
+    reloader = OverviewReloader(overview_path)
+    filerag_results = overview_path.parent / 'filerag_results'
+    filerag_results.mkdir(exist_ok=True)
+    log_file = filerag_results / 'api_response_log.txt'
+    query_cache = QueryCache(filerag_results / 'query_cache.db', QUERY_CACHE_TTL, QUERY_CACHE_SIZE)
+
+    # One client for the whole server, so its HTTP connection pool is shared by every request thread
+    server = ThreadingHTTPServer((host, port), make_request_handler(reloader, client, process_query, model, log_file, query_cache))
+    server.daemon_threads = True
+    print(f"Serving retrieval for {overview_path} on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        cache_stats = query_cache.stats()
+        print(f"Query cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+        print(get_metrics().format_summary("Retrieval summary"))
+        get_metrics().export()
+        print("Retrieval server stopped.")
+
+
+def get_percentile(sorted_values, percentile):
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percentile // 100))  # Nearest-rank method
+    return sorted_values[int(rank) - 1]
+
+
+def load_batch_queries(queries_path):
+    queries = []
+    with open(queries_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Skipping invalid JSON on line {line_number} of {queries_path}: {e}")
+                continue
+            if isinstance(record, str):
+                record = {'query': record}
+            if not isinstance(record, dict) or not record.get('query'):
+                print(f"Skipping line {line_number} of {queries_path}: no 'query' field")
+                continue
+            record.setdefault('id', line_number)
+            queries.append(record)
+    return queries
+
+
+def run_batch(queries_path, output_path, overview_path, client, process_query, model, concurrency=8, use_cache=True):
+    index = load_retrieval_index(overview_path)
+    filerag_results = index['folder_path'] / 'filerag_results'
+    filerag_results.mkdir(exist_ok=True)
+    log_file = filerag_results / 'api_response_log.txt'
+    query_cache = QueryCache(filerag_results / 'query_cache.db', QUERY_CACHE_TTL, QUERY_CACHE_SIZE) if use_cache else None
+    queries = load_batch_queries(queries_path)
+    print(f"Running {len(queries)} queries from {queries_path} with {concurrency} workers")
+
+    def run_one(record):
+        usage = {}
+        start = time.perf_counter()
+        try:
+            file_ids = answer_query(record['query'], index, client, process_query, model, log_file, query_cache, usage)
+        except Exception as e:
+            print(f"Error processing query {record['query']!r}: {e}")
+            file_ids = []
+            usage['error'] = str(e)
+        result = {
+            'id': record['id'],
+            'query': record['query'],
+            'file_ids': file_ids,
+            'latency_ms': round((time.perf_counter() - start) * 1000, 1),
+            'input_tokens': usage.get('input_tokens', 0),
+            'output_tokens': usage.get('output_tokens', 0),
+            'cache_read_tokens': usage.get('cache_read_tokens', 0),
+            'cache_write_tokens': usage.get('cache_write_tokens', 0),
+            'cache_hit': usage.get('cache_hit', False)
+        }
+        if 'error' in usage:
+            result['error'] = usage['error']
+        return result
+
+    latencies = []
+    summary = {
+        'queries': len(queries), 'errors': 0, 'cache_hits': 0,
+        'input_tokens': 0, 'output_tokens': 0, 'cache_read_tokens': 0, 'cache_write_tokens': 0
+    }
+    start = time.perf_counter()
+    # Results are written in input order as they become available, so a long run can be followed with tail -f
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, open(output_path, 'w', encoding='utf-8') as f:
+        for result in executor.map(run_one, queries):
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+            f.flush()
+            latencies.append(result['latency_ms'])
+            summary['errors'] += 'error' in result
+            summary['cache_hits'] += result['cache_hit']
+            summary['input_tokens'] += result['input_tokens']
+            summary['output_tokens'] += result['output_tokens']
+            summary['cache_read_tokens'] += result['cache_read_tokens']
+            summary['cache_write_tokens'] += result['cache_write_tokens']
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    summary['elapsed_seconds'] = round(elapsed, 3)
+    summary['queries_per_second'] = round(len(queries) / elapsed, 3) if elapsed > 0 else None
+    for percentile in [50, 90, 95, 99]:
+        summary[f'latency_p{percentile}_ms'] = get_percentile(latencies, percentile)
+    summary['latency_max_ms'] = latencies[-1] if latencies else None
+
+    summary_path = Path(output_path).with_suffix('.summary.json')
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    print(f"Batch finished: {summary['queries']} queries in {summary['elapsed_seconds']}s ({summary['queries_per_second']} queries/s)")
+    print(f"Latency p50 {summary['latency_p50_ms']} ms, p95 {summary['latency_p95_ms']} ms, p99 {summary['latency_p99_ms']} ms")
+    print(f"Tokens: {summary['input_tokens']} input, {summary['output_tokens']} output, {summary['cache_read_tokens']} read from and {summary['cache_write_tokens']} written to the prompt cache")
+    print(f"{summary['cache_hits']} query cache hits, {summary['errors']} errors")
+    print(f"Results have been saved to {output_path} and {summary_path}")
+    print(get_metrics().format_summary("Batch summary"))
+    get_metrics().export()
+    return summary
+
+
+def create_provider(model_choice):
+    if model_choice == 'a':
+        client = anthropic.Anthropic(api_key=get_api_key('anthropic'), max_retries=0)
+        return client, process_query_anthropic, ANTHROPIC_MODEL
+    if model_choice == 'o':
+        client = OpenAI(api_key=get_api_key('openai'), max_retries=0)
+        return client, process_query_openai, OPENAI_MODEL
+    return None
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Multimodal File Retriever")
+    parser.add_argument('--provider', choices=['a', 'o'], help="'a' for Anthropic or 'o' for OpenAI")
+    parser.add_argument('--overview', help="Path to folder_overview.json")
+    parser.add_argument('--serve', action='store_true', help="Run as an HTTP service instead of the interactive prompt")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--batch', help="Run the queries in this JSONL file instead of the interactive prompt")
+    parser.add_argument('--output', help="Where to write batch results (default: <batch file>.results.jsonl)")
+    parser.add_argument('--concurrency', type=int, default=8, help="Number of batch queries run at once")
+    parser.add_argument('--no-cache', action='store_true', help="Bypass the query cache in batch mode")
+    args = parser.parse_args()
+
     print("Welcome to the Multimodal File Retriever!")
     print("This script supports both Anthropic and OpenAI models.")
 
-    while True:
+    provider = create_provider(args.provider)
+    while provider is None:
         model_choice = input("Enter 'a' for Anthropic or 'o' for OpenAI: ").lower()
-
-        if model_choice == 'a':
-            api_key = get_api_key('anthropic')
-            client = anthropic.Anthropic(api_key=api_key)
-            process_query = process_query_anthropic
-            break
-        elif model_choice == 'o':
-            api_key = get_api_key('openai')
-            client = OpenAI(api_key=api_key)
-            process_query = process_query_openai
-            break
-        else:
+        provider = create_provider(model_choice)
+        if provider is None:
             print("Invalid choice. Please enter 'a' or 'o'.")
+    client, process_query, model = provider
 
-    overview_path = input("Enter the path to folder_overview.json: ")
+    overview_path = args.overview or input("Enter the path to folder_overview.json: ")
     overview_path = Path(overview_path).resolve()
 
     if not overview_path.is_file():
         print("Invalid folder_overview.json path.")
         return
 
-    folder_path = overview_path.parent
-    folder_overview = load_folder_overview(overview_path)
+    if args.serve:
+        serve(overview_path, client, process_query, model, args.host, args.port)
+        return
+    if args.batch:
+        output_path = args.output or Path(args.batch).with_suffix('.results.jsonl')
+        run_batch(args.batch, output_path, overview_path, client, process_query, model, args.concurrency, not args.no_cache)
+        return
+
+    # Reloaded between queries, so a session keeps up with an indexer running in --watch mode
+    reloader = OverviewReloader(overview_path)
     filerag_results, session_folder, image_results_folder, text_results_folder, audio_results_folder, video_results_folder = create_results_folders(
-        folder_path)
+        reloader.current()['folder_path'])
     log_file = filerag_results / 'api_response_log.txt'
+    query_cache = QueryCache(filerag_results / 'query_cache.db', QUERY_CACHE_TTL, QUERY_CACHE_SIZE)
+    materializer = ResultMaterializer()
 
     while True:
         query = input("Enter your query (or 'quit' to exit): ")
         if query.lower() == 'quit':
             break
 
-        file_ids = process_query(query, folder_overview, client, log_file)
-        print(f"File IDs returned by process_query: {file_ids}")
+        metrics_before = get_metrics().snapshot()
+        file_ids, results = run_query(query, reloader.current(), client, process_query, model, log_file, query_cache)
         if file_ids:
-            text_results = []
-            image_results = []
-            audio_results = []
-            video_results = []
-            for file_id in file_ids:
-                retrieved_path, content = retrieve_document(file_id, folder_path, folder_overview)
-                if retrieved_path:
-                    if content == "<<image_file>>":
-                        image_results.append((retrieved_path, content))
-                    elif content == "<<audio_file>>":
-                        audio_results.append((retrieved_path, content))
-                    elif content == "<<video_file>>":
-                        video_results.append((retrieved_path, content))
-                    else:
-                        text_results.append((retrieved_path, content))
-                    print(f"Retrieved document: {retrieved_path}")
-                else:
-                    print(f"Error: Unable to retrieve the document with file ID: {file_id}")
+            text_results = [(file_path, content) for _, file_path, content in results if get_result_type(content) == 'text']
+            image_results = [(file_path, content) for _, file_path, content in results if get_result_type(content) == 'image']
+            audio_results = [(file_path, content) for _, file_path, content in results if get_result_type(content) == 'audio']
+            video_results = [(file_path, content) for _, file_path, content in results if get_result_type(content) == 'video']
 
             if text_results:
                 write_results(text_results, session_folder)
             if image_results:
-                write_results(image_results, session_folder, is_image=True)
+                write_results(image_results, session_folder, is_image=True, materializer=materializer, query=query)
             if audio_results:
-                write_results(audio_results, session_folder, is_audio=True)
+                write_results(audio_results, session_folder, is_audio=True, materializer=materializer, query=query)
             if video_results:
-                write_results(video_results, session_folder, is_video=True)
+                write_results(video_results, session_folder, is_video=True, materializer=materializer, query=query)
 
-            if not text_results and not image_results and not audio_results and not video_results:
+            if not results:
                 print("No documents could be retrieved.")
         else:
             print("No matching documents found.")
+        print(get_metrics().format_summary("Query summary", metrics_before))
 
+    materializer.close()
+    cache_stats = query_cache.stats()
+    print(f"Query cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
     print(f"API response log has been saved to {log_file}")
+    print(get_metrics().format_summary("Session summary"))
+    get_metrics().export()
     print("Document retrieval process completed.")
 
 
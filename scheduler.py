@@ -0,0 +1,218 @@
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import anthropic
+from metrics import get_metrics, get_response_usage
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERROR_NAMES = {'APIConnectionError', 'APITimeoutError', 'ConnectionError', 'TimeoutError'}
+
+
+def get_provider_name(client):
+    if isinstance(client, anthropic.Anthropic):
+        return 'anthropic'
+    base_url = str(getattr(client, 'base_url', ''))
+    if 'lemonfox' in base_url:
+        return 'lemonfox'
+    return 'openai'
+
+
+def get_provider_setting(name, provider_name, default):
+    value = os.getenv(f"FILERAG_{name}_{provider_name.upper()}", os.getenv(f"FILERAG_{name}", default))
+    return int(value)
+
+
+def estimate_text_tokens(text):
+    return len(text) // 4
+
+
+def estimate_request_tokens(kwargs):
+    # A rough chars/4 estimate of the prompt plus the completion budget, used for TPM accounting
+    tokens = kwargs.get('max_tokens', 0)
+    system = kwargs.get('system', '')
+    texts = [system] if isinstance(system, str) else [block.get('text', '') for block in system]
+    for message in kwargs.get('messages', []):
+        content = message.get('content', '')
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for block in content:
+            if block.get('type') == 'text':
+                texts.append(block['text'])
+            else:
+                tokens += 1600  # Images are billed by size, not by their base64 length
+    return tokens + estimate_text_tokens(''.join(text for text in texts if isinstance(text, str)))
+
+
+def get_status_code(error):
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status_code
+
+
+def get_retry_after(error):
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        # Retry-After may also be an HTTP date
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def is_retryable(error, status_code):
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES or isinstance(error, (ConnectionError, TimeoutError))
+
+
+class TokenBucket:
+    def __init__(self, per_minute, clock=time.monotonic):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        # Takes the tokens up front and returns how long the caller has to wait for the debt to refill
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class AdaptiveLimiter:
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max(min_limit, max_limit)
+        self.min_limit = min_limit
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        # AIMD: halve the concurrency on a 429, grow it back by about one slot per window of successes
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit / 2)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class RequestScheduler:
+    def __init__(self, max_retries=None, base_delay=1.0, max_delay=60.0, clock=time.monotonic, sleep=time.sleep, rng=None):
+        self.max_retries = int(os.getenv('FILERAG_MAX_RETRIES', '5')) if max_retries is None else max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng or random.Random()
+        self.states = {}
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def get_state(self, provider_name, model):
+        # Rate limits are per model, but the in-flight cap is shared by all models of a provider
+        with self.lock:
+            limiter = self.limiters.get(provider_name)
+            if limiter is None:
+                limiter = AdaptiveLimiter(get_provider_setting('MAX_INFLIGHT', provider_name, '4'))
+                self.limiters[provider_name] = limiter
+            state = self.states.get((provider_name, model))
+            if state is None:
+                rpm = get_provider_setting('RPM', provider_name, '0')
+                tpm = get_provider_setting('TPM', provider_name, '0')
+                state = {
+                    'rpm': TokenBucket(rpm, self.clock) if rpm > 0 else None,
+                    'tpm': TokenBucket(tpm, self.clock) if tpm > 0 else None,
+                    'limiter': limiter
+                }
+                self.states[(provider_name, model)] = state
+            return state
+
+    def call(self, provider_name, create, **kwargs):
+        model = kwargs.get('model', '')
+        state = self.get_state(provider_name, model)
+        estimated_tokens = estimate_request_tokens(kwargs)
+
+        for attempt in range(self.max_retries + 1):
+            wait = 0.0
+            if state['rpm'] is not None:
+                wait = max(wait, state['rpm'].reserve(1))
+            if state['tpm'] is not None:
+                wait = max(wait, state['tpm'].reserve(estimated_tokens))
+            if wait > 0:
+                self.sleep(wait)
+
+            state['limiter'].acquire()
+            throttled = False
+            try:
+                return create(**kwargs)
+            except Exception as e:
+                status_code = get_status_code(e)
+                throttled = status_code == 429
+                if attempt == self.max_retries or not is_retryable(e, status_code):
+                    raise
+                delay = get_retry_after(e)
+                if delay is None:
+                    delay = self.rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                print(f"{provider_name} request failed ({status_code or type(e).__name__}), retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+            finally:
+                state['limiter'].release(throttled)
+
+            self.sleep(delay)
+            for value in kwargs.values():
+                if hasattr(value, 'seek'):
+                    value.seek(0)  # Rewind uploads so the retry sends the whole file again
+
+
+default_scheduler = None
+default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler():
+    global default_scheduler
+    with default_scheduler_lock:
+        if default_scheduler is None:
+            default_scheduler = RequestScheduler()
+        return default_scheduler
+
+
+def call_provider(client, create, scheduler=None, **kwargs):
+    if scheduler is None:
+        scheduler = get_default_scheduler()
+    # Timed around the scheduler, so the API stage includes rate-limit waits and retries
+    start = time.perf_counter()
+    try:
+        response = scheduler.call(get_provider_name(client), create, **kwargs)
+    except Exception:
+        get_metrics().record_api_call(kwargs.get('model', ''), time.perf_counter() - start, error=True)
+        raise
+    get_metrics().record_api_call(kwargs.get('model', ''), time.perf_counter() - start, get_response_usage(response))
+    return response
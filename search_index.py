@@ -0,0 +1,295 @@
+import bisect
+import heapq
+import json
+import math
+import os
+import posixpath
+import re
+import zlib
+from collections import Counter
+from pathlib import Path
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'[^\W_]+', re.UNICODE)
+EMBEDDING_DIM = 512
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def get_document_text(item):
+    # File names and folders carry a lot of signal, so they are indexed with the summary
+    return f"{item['file_path']} {item['file_name']} {item['summary']}"
+
+
+def build_bm25_index(folder_overview):
+    print(f"Building BM25 index for {len(folder_overview)} items")
+    postings = {}
+    doc_lengths = []
+    for doc_id, item in enumerate(folder_overview):
+        tokens = tokenize(get_document_text(item))
+        doc_lengths.append(len(tokens))
+        for term, frequency in Counter(tokens).items():
+            postings.setdefault(term, []).append([doc_id, frequency])
+
+    return {
+        'file_ids': [item['file_id'] for item in folder_overview],
+        'doc_lengths': doc_lengths,
+        'avg_doc_length': sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0,
+        'postings': postings
+    }
+
+
+def save_bm25_index(index_path, index):
+    temp_path = index_path.with_name(index_path.name + '.tmp')
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, index_path)
+    print(f"BM25 index has been saved to {index_path}")
+
+
+def load_bm25_index(index_path):
+    if not index_path.is_file():
+        print(f"No BM25 index found at {index_path}")
+        return None
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        print(f"Loaded BM25 index with {len(index['file_ids'])} items")
+        return index
+    except Exception as e:
+        print(f"Error loading BM25 index {index_path}: {e}")
+        return None
+
+
+def get_restricted_postings(term_postings, restricted_doc_ids, restricted_set):
+    # Postings are sorted by doc_id, so a small restriction is looked up by binary search instead of a full scan
+    if len(restricted_doc_ids) * max(1, len(term_postings).bit_length()) < len(term_postings):
+        matches = []
+        for doc_id in restricted_doc_ids:
+            position = bisect.bisect_left(term_postings, [doc_id])
+            if position < len(term_postings) and term_postings[position][0] == doc_id:
+                matches.append(term_postings[position])
+        return matches
+    return [posting for posting in term_postings if posting[0] in restricted_set]
+
+
+def get_restricted_doc_ids(index, restrict_to):
+    if 'doc_ids' not in index:
+        index['doc_ids'] = {file_id: doc_id for doc_id, file_id in enumerate(index['file_ids'])}
+    restricted_set = {index['doc_ids'][file_id] for file_id in restrict_to if file_id in index['doc_ids']}
+    return sorted(restricted_set), restricted_set
+
+
+def has_missing_terms(index, query, restrict_to):
+    # True when a query term occurs in the folder but in none of the given files
+    restricted_doc_ids, restricted_set = get_restricted_doc_ids(index, restrict_to)
+    for term in set(tokenize(query)):
+        term_postings = index['postings'].get(term)
+        if term_postings and not get_restricted_postings(term_postings, restricted_doc_ids, restricted_set):
+            return True
+    return False
+
+
+def bm25_search(index, query, top_k, k1=1.5, b=0.75, restrict_to=None):
+    doc_count = len(index['file_ids'])
+    avg_doc_length = index['avg_doc_length'] or 1.0
+    doc_lengths = index['doc_lengths']
+    scores = {}
+
+    restricted_doc_ids = restricted_set = None
+    if restrict_to is not None:
+        restricted_doc_ids, restricted_set = get_restricted_doc_ids(index, restrict_to)
+
+    for term in set(tokenize(query)):
+        term_postings = index['postings'].get(term)
+        if not term_postings:
+            continue
+        idf = math.log(1 + (doc_count - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+        if restricted_doc_ids is not None:
+            term_postings = get_restricted_postings(term_postings, restricted_doc_ids, restricted_set)
+        for doc_id, frequency in term_postings:
+            norm = k1 * (1 - b + b * doc_lengths[doc_id] / avg_doc_length)
+            scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (k1 + 1) / (frequency + norm)
+
+    ranked = heapq.nlargest(top_k, scores.items(), key=lambda hit: hit[1])
+    return [(index['file_ids'][doc_id], score) for doc_id, score in ranked]
+
+
+def get_ngram_features(text):
+    features = []
+    for token in tokenize(text):
+        features.append(token)
+        padded = f"<{token}>"
+        features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+    return features
+
+
+def hashed_ngram_embedder(texts, dim=EMBEDDING_DIM):
+    # Signed feature hashing of words and character trigrams, so paraphrases that share stems still overlap
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for feature in get_ngram_features(text):
+            hashed = zlib.crc32(feature.encode('utf-8'))
+            vectors[row, hashed % dim] += 1.0 if hashed & 0x80000000 else -1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+EMBEDDERS = {
+    'hashed-ngram': hashed_ngram_embedder
+}
+
+
+def build_vector_index(folder_overview, embedder_name='hashed-ngram'):
+    print(f"Embedding {len(folder_overview)} items with {embedder_name}")
+    embedder = EMBEDDERS[embedder_name]
+    return embedder([get_document_text(item) for item in folder_overview])
+
+
+def save_vector_index(vectors_path, vectors, folder_overview, embedder_name='hashed-ngram'):
+    temp_path = vectors_path.with_name(vectors_path.name + '.tmp')
+    with open(temp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+    os.replace(temp_path, vectors_path)
+
+    meta_path = vectors_path.with_suffix('.json')
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'embedder': embedder_name,
+            'dim': int(vectors.shape[1]),
+            'file_ids': [item['file_id'] for item in folder_overview]
+        }, f, ensure_ascii=False)
+    print(f"Vector index has been saved to {vectors_path}")
+
+
+def load_vector_index(vectors_path):
+    meta_path = vectors_path.with_suffix('.json')
+    if not vectors_path.is_file() or not meta_path.is_file():
+        print(f"No vector index found at {vectors_path}")
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        vectors = np.load(vectors_path, mmap_mode='r')
+        if vectors.shape[0] != len(meta['file_ids']) or meta['embedder'] not in EMBEDDERS:
+            print(f"Vector index {vectors_path} does not match its metadata, ignoring it")
+            return None
+        print(f"Loaded vector index with {vectors.shape[0]} items")
+        return {
+            'vectors': vectors,
+            'embedder': meta['embedder'],
+            'file_ids': meta['file_ids'],
+            'rows': {file_id: row for row, file_id in enumerate(meta['file_ids'])}
+        }
+    except Exception as e:
+        print(f"Error loading vector index {vectors_path}: {e}")
+        return None
+
+
+def vector_search(vector_index, query, top_k, restrict_to=None):
+    vectors = vector_index['vectors']
+    query_vector = EMBEDDERS[vector_index['embedder']]([query], dim=vectors.shape[1])[0]
+    if restrict_to is None:
+        rows = np.arange(vectors.shape[0])
+    else:
+        rows = np.array(sorted(vector_index['rows'][file_id] for file_id in restrict_to if file_id in vector_index['rows']), dtype=np.int64)
+    if not query_vector.any() or len(rows) == 0:
+        return []
+
+    scores = (vectors if restrict_to is None else vectors[rows]) @ query_vector
+    top_k = min(top_k, len(scores))
+    top_indices = np.argpartition(-scores, top_k - 1)[:top_k]
+    top_indices = top_indices[np.argsort(-scores[top_indices], kind='stable')]
+    return [(vector_index['file_ids'][rows[i]], float(scores[i])) for i in top_indices if scores[i] > 0]
+
+
+def get_directory_path(item):
+    directory = Path(item['file_path']).parent.as_posix()
+    return '' if directory == '.' else directory
+
+
+def build_overview_tree(folder_overview, bm25_index, max_terms=50):
+    print(f"Building directory overview tree for {len(folder_overview)} items")
+    doc_count = len(bm25_index['file_ids'])
+    idf = {
+        term: math.log(1 + (doc_count - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+        for term, term_postings in bm25_index['postings'].items()
+    }
+    nodes = {}
+
+    def get_node(path):
+        if path not in nodes:
+            nodes[path] = {'path': path, 'summary': '', 'subdirs': [], 'files': [], 'file_count': 0, 'terms': Counter()}
+            if path:
+                get_node(posixpath.dirname(path))['subdirs'].append(path)
+        return nodes[path]
+
+    for item in folder_overview:
+        node = get_node(get_directory_path(item))
+        node['files'].append(item['file_id'])
+        node['file_count'] += 1
+        for term, frequency in Counter(tokenize(get_document_text(item))).items():
+            node['terms'][term] += frequency * idf.get(term, 0.0)
+
+    # Roll terms and file counts up from the deepest folders to the root
+    for path in sorted(nodes, key=lambda p: p.count('/') + 1 if p else 0, reverse=True):
+        node = nodes[path]
+        node['terms'] = dict(Counter(node['terms']).most_common(max_terms))
+        top_terms = ', '.join(list(node['terms'])[:10])
+        node['summary'] = f"Folder '{path or '.'}' with {node['file_count']} files in {len(node['subdirs'])} subfolders. Main topics: {top_terms}"
+        if path:
+            parent = nodes[posixpath.dirname(path)]
+            parent['file_count'] += node['file_count']
+            for term, weight in node['terms'].items():
+                parent['terms'][term] += weight
+
+    return {'nodes': nodes}
+
+
+def save_overview_tree(tree_path, tree):
+    temp_path = tree_path.with_name(tree_path.name + '.tmp')
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(tree, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, tree_path)
+    print(f"Directory overview tree has been saved to {tree_path}")
+
+
+def load_overview_tree(tree_path):
+    if not tree_path.is_file():
+        print(f"No directory overview tree found at {tree_path}")
+        return None
+    try:
+        with open(tree_path, 'r', encoding='utf-8') as f:
+            tree = json.load(f)
+        print(f"Loaded directory overview tree with {len(tree['nodes'])} folders")
+        return tree
+    except Exception as e:
+        print(f"Error loading directory overview tree {tree_path}: {e}")
+        return None
+
+
+def route_query(tree, query, beam_width=3):
+    # Beam search down the folder tree, only scoring the subfolders of the folders kept at each level
+    nodes = tree['nodes']
+    query_terms = set(tokenize(query))
+    frontier = ['']
+    routed_files = []
+    visited = 0
+
+    while frontier:
+        next_level = []
+        for path in frontier:
+            node = nodes[path]
+            routed_files.extend(node['files'])
+            for subdir in node['subdirs']:
+                visited += 1
+                score = sum(nodes[subdir]['terms'].get(term, 0.0) for term in query_terms)
+                if score > 0:
+                    next_level.append((score, subdir))
+        frontier = [subdir for _, subdir in heapq.nlargest(beam_width, next_level)]
+
+    print(f"Routed query to {len(routed_files)} files after scoring {visited} folders")
+    return routed_files
@@ -0,0 +1,193 @@
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import pytest
+from scheduler import AdaptiveLimiter, RequestScheduler, TokenBucket, get_retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class MaxRandom:
+    # Always picks the top of the backoff range, so the delays are deterministic
+    def uniform(self, low, high):
+        return high
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(status_code=status_code, headers=headers or {})
+
+
+class FakeClient:
+    # Fails with the queued errors in order, then succeeds
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return SimpleNamespace(usage=None, model=kwargs.get('model'))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    for name in ['FILERAG_RPM', 'FILERAG_TPM', 'FILERAG_MAX_INFLIGHT', 'FILERAG_RPM_TEST', 'FILERAG_TPM_TEST', 'FILERAG_MAX_INFLIGHT_TEST']:
+        monkeypatch.delenv(name, raising=False)
+    return FakeClock()
+
+
+def make_scheduler(clock, max_retries=3):
+    return RequestScheduler(max_retries=max_retries, base_delay=1.0, max_delay=60.0, clock=clock, sleep=clock.sleep, rng=MaxRandom())
+
+
+def test_token_bucket_refills_at_the_per_minute_rate(clock):
+    bucket = TokenBucket(60, clock)
+    assert bucket.reserve(60) == 0.0
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    clock.now += 1.0
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    clock.now += 120.0
+    assert bucket.reserve(60) == 0.0
+
+
+def test_token_bucket_caps_oversized_requests_at_capacity(clock):
+    bucket = TokenBucket(60, clock)
+    assert bucket.reserve(1000) == 0.0
+    assert bucket.reserve(60) == pytest.approx(60.0)
+
+
+def test_adaptive_limiter_halves_on_throttle_and_grows_back():
+    limiter = AdaptiveLimiter(8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 4
+    limiter.acquire()
+    limiter.release(throttled=True)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 1
+    for _ in range(3):
+        limiter.acquire()
+        limiter.release()
+    assert 2 <= limiter.limit < 3
+
+
+@pytest.mark.parametrize('headers, expected', [
+    ({'retry-after-ms': '250'}, 0.25),
+    ({'retry-after': '3'}, 3.0),
+    ({'retry-after-ms': '1500', 'retry-after': '9'}, 1.5),
+    ({'retry-after-ms': 'soon'}, None),
+    ({'retry-after-ms': 'soon', 'retry-after': '2'}, 2.0),
+    ({'retry-after': 'not a date'}, None),
+    ({}, None),
+])
+def test_get_retry_after(headers, expected):
+    assert get_retry_after(FakeAPIError(429, headers)) == expected
+
+
+def test_get_retry_after_accepts_http_dates():
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    delay = get_retry_after(FakeAPIError(503, {'retry-after': format_datetime(retry_at, usegmt=True)}))
+    assert 25 <= delay <= 30
+
+
+def test_call_waits_for_retry_after_on_429(clock):
+    scheduler = make_scheduler(clock)
+    client = FakeClient([FakeAPIError(429, {'retry-after-ms': '2000'})])
+    response = scheduler.call('test', client.create, model='m')
+    assert response.model == 'm'
+    assert client.calls == 2
+    assert clock.sleeps == [2.0]
+    assert scheduler.get_state('test', 'm')['limiter'].limit < 4
+
+
+def test_call_backs_off_exponentially_without_retry_after(clock):
+    scheduler = make_scheduler(clock)
+    client = FakeClient([FakeAPIError(503), FakeAPIError(503), FakeAPIError(503)])
+    scheduler.call('test', client.create, model='m')
+    assert clock.sleeps == [1.0, 2.0, 4.0]
+
+
+def test_call_backs_off_on_unparseable_retry_after(clock):
+    scheduler = make_scheduler(clock)
+    client = FakeClient([FakeAPIError(429, {'retry-after-ms': 'soon'})])
+    scheduler.call('test', client.create, model='m')
+    assert clock.sleeps == [1.0]
+
+
+def test_call_raises_non_retryable_errors_immediately(clock):
+    scheduler = make_scheduler(clock)
+    client = FakeClient([FakeAPIError(400)])
+    with pytest.raises(FakeAPIError):
+        scheduler.call('test', client.create, model='m')
+    assert client.calls == 1
+    assert clock.sleeps == []
+
+
+def test_call_raises_the_api_error_after_the_last_retry(clock):
+    scheduler = make_scheduler(clock, max_retries=2)
+    errors = [FakeAPIError(429), FakeAPIError(429), FakeAPIError(429)]
+    client = FakeClient(errors)
+    with pytest.raises(FakeAPIError) as excinfo:
+        scheduler.call('test', client.create, model='m')
+    assert excinfo.value is errors[-1]
+    assert client.calls == 3
+
+
+def test_call_waits_for_the_request_rate_limit(clock, monkeypatch):
+    monkeypatch.setenv('FILERAG_RPM_TEST', '60')
+    scheduler = make_scheduler(clock)
+    client = FakeClient()
+    for _ in range(61):
+        scheduler.call('test', client.create, model='m')
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_call_waits_for_the_token_rate_limit(clock, monkeypatch):
+    monkeypatch.setenv('FILERAG_TPM_TEST', '1000')
+    scheduler = make_scheduler(clock)
+    client = FakeClient()
+    scheduler.call('test', client.create, model='m', max_tokens=800)
+    scheduler.call('test', client.create, model='m', max_tokens=800)
+    assert clock.sleeps == [pytest.approx(600 * 60 / 1000)]
+
+
+def test_call_rewinds_uploads_before_retrying(clock):
+    class Upload:
+        position = 5
+
+        def seek(self, position):
+            self.position = position
+
+    upload = Upload()
+    scheduler = make_scheduler(clock)
+    client = FakeClient([FakeAPIError(500)])
+    scheduler.call('test', client.create, model='m', file=upload)
+    assert upload.position == 0
+
+
+def test_models_of_a_provider_share_the_in_flight_limit(clock, monkeypatch):
+    monkeypatch.setenv('FILERAG_RPM_TEST', '60')
+    scheduler = make_scheduler(clock)
+    haiku = scheduler.get_state('test', 'haiku')
+    sonnet = scheduler.get_state('test', 'sonnet')
+    assert haiku['limiter'] is sonnet['limiter']
+    assert haiku['rpm'] is not sonnet['rpm']
+    assert scheduler.get_state('other', 'haiku')['limiter'] is not haiku['limiter']
@@ -0,0 +1,152 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    def __init__(self, root, ignore):
+        self.root = Path(root)
+        self.ignore = ignore
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        self.directories = {}
+        try:
+            self.watch_tree(self.root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def watch_tree(self, directory):
+        for root, dirs, _ in os.walk(directory):
+            dirs[:] = [d for d in dirs if not self.ignore(Path(root, d).relative_to(self.root))]
+            wd = self.add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                # ENOSPC means fs.inotify.max_user_watches is exhausted
+                raise OSError(errno, f"Cannot watch {root}: {os.strerror(errno)}")
+            self.directories[wd] = Path(root)
+
+    def read_events(self):
+        changes = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + name_length
+                if mask & IN_Q_OVERFLOW:
+                    print("inotify event queue overflowed, re-indexing the whole folder")
+                    changes.add(Path('.'))
+                    continue
+                if mask & IN_IGNORED:
+                    self.directories.pop(wd, None)
+                    continue
+                directory = self.directories.get(wd)
+                if directory is None:
+                    continue
+                path = directory / os.fsdecode(name) if name else directory
+                relative_path = path.relative_to(self.root)
+                if self.ignore(relative_path):
+                    continue
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    # New folders need their own watches; files created in them before that are found by the re-index
+                    try:
+                        self.watch_tree(path)
+                    except OSError as e:
+                        print(f"Cannot watch new folder {path}: {e}")
+                changes.add(relative_path)
+
+    def wait(self, timeout=None):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        return self.read_events() if ready else set()
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    def __init__(self, root, ignore, interval=None):
+        self.root = Path(root)
+        self.ignore = ignore
+        self.interval = float(os.getenv('FILERAG_WATCH_POLL', '5')) if interval is None else interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        # One stat per file from os.scandir; on Windows the directory listing already carries it
+        snapshot = {}
+        pending = [self.root]
+        while pending:
+            directory = pending.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        relative_path = Path(entry.path).relative_to(self.root)
+                        if self.ignore(relative_path):
+                            continue
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                pending.append(entry.path)
+                            elif entry.is_file():
+                                stat = entry.stat()
+                                snapshot[relative_path] = (stat.st_size, stat.st_mtime_ns)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        return snapshot
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval if deadline is None else min(self.interval, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+            snapshot = self.scan()
+            changes = {path for path in snapshot.keys() | self.snapshot.keys() if snapshot.get(path) != self.snapshot.get(path)}
+            self.snapshot = snapshot
+            if changes or (deadline is not None and time.monotonic() >= deadline):
+                return changes
+
+    def close(self):
+        pass
+
+
+def create_watcher(root, ignore):
+    if sys.platform.startswith('linux') and os.getenv('FILERAG_WATCH_POLL_ONLY', '0') != '1':
+        try:
+            watcher = InotifyWatcher(root, ignore)
+            print(f"Watching {root} with inotify ({len(watcher.directories)} folders)")
+            return watcher
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable, falling back to polling: {e}")
+    watcher = PollingWatcher(root, ignore)
+    print(f"Watching {root} by polling every {watcher.interval:g}s")
+    return watcher